@@ -0,0 +1,209 @@
+"""The steward on an asyncio event loop.
+
+Each stage of the process runs under its own limit, so many files are in
+flight at once while none of the disks, ffprobe or the database is asked for
+more than it could take.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import logging.config
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from metrics import METRICS
+from rabbit import Rabbit
+from sniffer import sniff_video
+from steward import CFG, Steward, get_video_tags
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('steward')
+
+
+async def probe_video(video_path):
+    """Return the tags of the video, forking ffprobe without a thread."""
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-show_format', '-show_streams', '-of', 'json', video_path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    out, err = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("ffprobe error: {}".format(err.decode(errors='replace')))
+
+    return json.loads(out.decode())
+
+
+class AsyncSteward(Steward):
+
+    def __init__(self, stocker, clark, journal_file=None, node=None):
+        """An asynchronous steward in charge of the data processing project.
+
+        The blocking file and database calls run in bounded thread pools, and
+        ffprobe runs as an asyncio subprocess.
+
+        Args:
+            clark: a clark to manage the books.
+            stocker: a stocker to fill the warehouse.
+            journal_file: the journal of the files in process.
+            node: the name of this steward among those sharing the warehouse.
+        """
+        super().__init__(stocker, clark, journal_file, node)
+
+        limits = CFG['steward']['async']
+        self.in_flight = limits['in_flight']
+        self._limits = {stage: limits[stage] for stage in ('io', 'probe', 'db')}
+        self._io_pool = ThreadPoolExecutor(max_workers=limits['io'],
+                                           thread_name_prefix='steward-io')
+        self._db_pool = ThreadPoolExecutor(max_workers=limits['db'],
+                                           thread_name_prefix='steward-db')
+        self._loop = None
+        self._gates = {}
+
+    async def in_pool(self, stage, func, *args):
+        """Run the blocking function in the pool of the stage, once it is
+        allowed in."""
+        pool = self._db_pool if stage == 'db' else self._io_pool
+        async with self._gates[stage]:
+            return await self._loop.run_in_executor(
+                pool, functools.partial(func, *args))
+
+    async def get_raw_tags_async(self, src_file, parse_func):
+        """Get the tags from the source file without blocking the loop.
+
+        Returns:
+            process_succeed: a boolean value indicating the process status
+            raw_tags: the parsed results.
+        """
+        if parse_func is not get_video_tags:
+            return await self.in_pool('io', self.get_raw_tags, src_file,
+                                      parse_func)
+
+        # Most videos could be told from the headers without forking ffprobe.
+        try:
+            tags = await self.in_pool('io', sniff_video, src_file)
+            if tags is None:
+                async with self._gates['probe']:
+                    tags = await probe_video(src_file)
+            return True, tags
+        except FileNotFoundError:
+            logger.error("FFMPEG not installed correctly.")
+        except:
+            logger.debug("{}: Failed to open file.".format(src_file))
+
+        return False, {}
+
+    async def file_async(self, func, *args):
+        """Run the filing call and wait until its callback is called.
+
+        Returns:
+            the arguments of the callback.
+        """
+        future = self._loop.create_future()
+
+        def settled(*result):
+            self._loop.call_soon_threadsafe(future.set_result, result)
+
+        # The record may be written right away if the bulk is full.
+        await self.in_pool('db', func, *args, settled)
+        return await future
+
+    async def process_async(self, src_file):
+        """Process the sample file through the same stages as
+        `Steward.process`, each blocking call in the pool of its stage.
+
+        Returns:
+            (succeed, record_id, retry) of the file.
+        """
+        stages = self.stages(src_file)
+        result = None
+        try:
+            while True:
+                stage, func, *args = stages.send(result)
+                if stage == 'file':
+                    result = await self.file_async(func, *args)
+                elif stage == 'probe':
+                    result = await self.get_raw_tags_async(*args)
+                else:
+                    result = await self.in_pool(stage, func, *args)
+        except StopIteration as e:
+            return e.value
+
+    async def work_async(self, ch, delivery_tag, body, attempts):
+        """Process the file in the message on the event loop."""
+        src_file = body.decode()
+        logger.info(" *  File created: {}".format(src_file))
+
+        # Another node is working on the same file. Leave it alone.
+        if not await self.in_pool('db', self.lease, src_file):
+            logger.info("    File taken by another node.")
+            METRICS.count('dwarf_files_total', outcome='leased')
+            await self.in_pool('io', self.report, ch, delivery_tag, body,
+                               attempts, False, None)
+            return
+
+        try:
+            succeed, record_id, retry = await self.process_async(src_file)
+        except:
+            logger.exception("{}: Unexpected error.".format(src_file))
+            succeed, record_id, retry = False, None, False
+        await self.in_pool('db', self.release, src_file)
+
+        await self.in_pool('io', self.report, ch, delivery_tag, body,
+                           attempts, succeed, record_id, retry)
+
+    def callback(self, ch, method, properties, body):
+        """Hand the message over to the event loop.
+
+        This is called on the connection thread. The number of files in
+        flight is bounded by the prefetch count.
+        """
+        attempts = (properties.headers or {}).get('x-attempts', 0)
+        self._loop.call_soon_threadsafe(
+            self._loop.create_task,
+            self.work_async(ch, method.delivery_tag, body, attempts))
+
+    def listen(self):
+        """Listen to the rabbit on the connection thread."""
+        self._rabbit = Rabbit(address=CFG['rabbitmq']['host'],
+                              port=CFG['rabbitmq']['port'],
+                              queue=CFG['rabbitmq']['queue'],
+                              talking=False,
+                              callback=self.callback,
+                              retry_delay=CFG['monitor']['retry_delay'],
+                              num_shards=CFG['rabbitmq']['shards'],
+                              shards=self.shards,
+                              heartbeat=CFG['rabbitmq']['heartbeat'])
+
+        self._rabbit.every(CFG['metrics']['queue_interval'],
+                           lambda: METRICS.set('dwarf_queue_depth',
+                                               self._rabbit.queue_depth()))
+
+        logger.info('[*] Waiting for messages...')
+        self._rabbit.start_listening(prefetch_count=self.in_flight)
+
+    async def run(self):
+        """Run the event loop until the connection is closed."""
+        self._loop = asyncio.get_running_loop()
+        self._gates = {stage: asyncio.Semaphore(limit)
+                       for stage, limit in self._limits.items()}
+
+        listener = self._loop.create_future()
+
+        def listen():
+            try:
+                self.listen()
+                self._loop.call_soon_threadsafe(listener.set_result, None)
+            except BaseException as e:
+                self._loop.call_soon_threadsafe(listener.set_exception, e)
+
+        threading.Thread(target=listen, name='rabbit', daemon=True).start()
+        await listener
+
+    def start_processing(self):
+        """Start to process new files in the barn"""
+        self.recover()
+        asyncio.run(self.run())
@@ -0,0 +1,110 @@
+"""Fill a barn with synthetic files for the benchmark."""
+
+import os
+import random
+import shutil
+import struct
+
+# The scenarios: how many small images, how many large videos, and how many
+# of the files are copies of the others.
+SCENARIOS = {
+    "small": {"images": 1.0, "videos": 0.0, "duplicates": 0.0},
+    "large": {"images": 0.0, "videos": 1.0, "duplicates": 0.0},
+    "mixed": {"images": 0.9, "videos": 0.1, "duplicates": 0.1},
+    "duplicated": {"images": 0.8, "videos": 0.2, "duplicates": 0.6},
+}
+
+
+def make_jpeg(path, width, height):
+    """Write a JPEG image of random pixels."""
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    if Image is not None:
+        pixels = os.urandom(width * height * 3)
+        Image.frombytes('RGB', (width, height), pixels).save(path, 'JPEG')
+        return
+
+    # Without PIL, write a JPEG header followed by some random data. Only
+    # the header is needed by the fast tag reader.
+    sof = struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8\xff\xc0' + sof + os.urandom(width * height // 4))
+
+
+def _box(box_type, payload):
+    """Make an MP4 box."""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def make_mp4(path, size, width=1920, height=1080, seconds=60):
+    """Write an MP4 file with a valid `moov` atom and random media data."""
+    version_flags = b'\x00\x00\x00\x00'
+    mvhd = _box(b'mvhd', version_flags
+                + struct.pack('>IIII', 0, 0, 1000, seconds * 1000)
+                + b'\x00' * 80)
+    entry = (struct.pack('>I4s', 86, b'avc1') + b'\x00' * 6 + b'\x00\x01'
+             + b'\x00' * 16 + struct.pack('>HH', width, height)
+             + b'\x00' * 50)
+    stsd = _box(b'stsd', version_flags + struct.pack('>I', 1) + entry)
+    mdhd = _box(b'mdhd', version_flags
+                + struct.pack('>IIII', 0, 0, 90000, seconds * 90000)
+                + b'\x00' * 4)
+    hdlr = _box(b'hdlr', version_flags + b'\x00' * 4 + b'vide' + b'\x00' * 12)
+    trak = _box(b'trak', _box(b'mdia', mdhd + hdlr
+                              + _box(b'minf', _box(b'stbl', stsd))))
+    moov = _box(b'moov', mvhd + trak)
+    ftyp = _box(b'ftyp', b'isom\x00\x00\x02\x00isomiso2avc1mp41')
+
+    with open(path, 'wb') as f:
+        f.write(ftyp + moov)
+        remaining = max(size - len(ftyp) - len(moov) - 8, 0)
+        f.write(struct.pack('>I4s', remaining + 8, b'mdat'))
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def fill(barn, scenario, num_files, video_size, seed=0):
+    """Fill the barn with the files of the scenario.
+
+    Args:
+        barn: the barn directory.
+        scenario: one of the SCENARIOS.
+        num_files: how many files in total.
+        video_size: the size of each video in bytes.
+        seed: the random seed.
+
+    Returns:
+        a list of the files made.
+    """
+    mix = SCENARIOS[scenario]
+    rng = random.Random(seed)
+    job = os.path.join(barn, "bench")
+    os.makedirs(job, exist_ok=True)
+
+    # Every file needs the manual tags and authors.
+    with open(os.path.join(job, "tags.txt"), 'w') as f:
+        f.write("bench synthetic")
+    with open(os.path.join(job, "authors.txt"), 'w') as f:
+        f.write("dwarf")
+
+    files = []
+    for index in range(num_files):
+        if files and rng.random() < mix["duplicates"]:
+            original = rng.choice(files)
+            path = os.path.join(job, "copy{:06d}{}".format(
+                index, os.path.splitext(original)[-1]))
+            shutil.copyfile(original, path)
+        elif rng.random() < mix["videos"]:
+            path = os.path.join(job, "video{:06d}.mp4".format(index))
+            make_mp4(path, video_size)
+        else:
+            path = os.path.join(job, "image{:06d}.jpg".format(index))
+            make_jpeg(path, rng.choice([64, 128, 256]), rng.choice([64, 128]))
+        files.append(path)
+
+    return files
@@ -0,0 +1,220 @@
+"""Measure the ingest throughput of Dwarf on a synthetic barn.
+
+The steward runs with its real stocker, worker pool and tag parsers, while
+MongoDB, RabbitMQ and ffprobe are replaced by in-process stand-ins unless
+asked otherwise.
+
+Usage:
+    python3 bench/run.py config.yml --scenario mixed --files 2000
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stopwatch:
+
+    def __init__(self):
+        """Record how long every stage takes."""
+        self.laps = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def wrap(self, obj, method, stage):
+        """Time every call of the method of the object as the stage."""
+        func = getattr(obj, method)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                lap = time.perf_counter() - start
+                with self._lock:
+                    self.laps[stage].append(lap)
+
+        setattr(obj, method, timed)
+
+    def lap(self, stage, seconds):
+        """Record a lap of the stage timed elsewhere."""
+        with self._lock:
+            self.laps[stage].append(seconds)
+
+    def summary(self):
+        """Return the latency percentiles of every stage in milliseconds."""
+        result = {}
+        for stage, laps in sorted(self.laps.items()):
+            laps = sorted(laps)
+            result[stage] = {"count": len(laps),
+                             "p50": percentile(laps, 50) * 1000,
+                             "p90": percentile(laps, 90) * 1000,
+                             "p99": percentile(laps, 99) * 1000,
+                             "max": laps[-1] * 1000}
+        return result
+
+
+def percentile(laps, p):
+    """Return the p-th percentile of the sorted laps."""
+    index = min(len(laps) - 1, int(round(p / 100 * (len(laps) - 1))))
+    return laps[index]
+
+
+def make_config(base_file, workdir, args):
+    """Write a config file for the benchmark and return its path."""
+    with open(base_file, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+
+    cfg['dirs'] = {"barn": os.path.join(workdir, "barn"),
+                   "warehouse": os.path.join(workdir, "warehouse")}
+    cfg['steward']['workers'] = args.workers
+    cfg['monitor']['settle'] = 0
+    if args.mongo:
+        cfg['mongodb']['collections'] = {"images": "bench_images",
+                                         "videos": "bench_videos"}
+
+    config_file = os.path.join(workdir, "config.yml")
+    with open(config_file, 'w') as f:
+        yaml.dump(cfg, f)
+    return config_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest of Dwarf.")
+    parser.add_argument('config', help="the base configuration file")
+    parser.add_argument('--scenario', default='mixed',
+                        choices=['small', 'large', 'mixed', 'duplicated'])
+    parser.add_argument('--files', type=int, default=1000,
+                        help="how many files in the barn")
+    parser.add_argument('--video-mb', type=int, default=64,
+                        help="the size of every video in MB")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="how many workers the steward employs")
+    parser.add_argument('--mongo', action='store_true',
+                        help="use the MongoDB in the config file")
+    parser.add_argument('--ffprobe', action='store_true',
+                        help="probe the videos with the real ffprobe")
+    parser.add_argument('--output', help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="dwarf-bench-")
+    config_file = make_config(args.config, workdir, args)
+
+    # The modules read the config file from the command line and the logging
+    # config from the working directory.
+    sys.argv = [sys.argv[0], config_file]
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    import steward
+    from bench.barn import fill
+    from bench.standins import MemoryChannel, MemoryClerk, MemoryRabbit, fake_probe
+    from stocker import Stocker
+    for name in ('steward', 'stocker', 'clerk', 'scout'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    try:
+        cfg = steward.CFG
+        files = fill(cfg['dirs']['barn'], args.scenario, args.files,
+                     args.video_mb * 1024 * 1024)
+        num_bytes = sum(os.path.getsize(f) for f in files)
+
+        if args.mongo:
+            from clerk import Clerk
+            clerk = Clerk(cfg['mongodb']["host"],
+                          cfg['mongodb']['port'],
+                          cfg['mongodb']['username'],
+                          cfg['mongodb']['password'],
+                          cfg["mongodb"]['name'],
+                          cfg["mongodb"]['collections'].values(),
+                          cfg["mongodb"]['bulk']['size'],
+                          cfg["mongodb"]['bulk']['interval'])
+        else:
+            clerk = MemoryClerk()
+        if not args.ffprobe:
+            steward.ffmpeg.probe = fake_probe
+
+        stocker = Stocker(cfg['dirs']['barn'], cfg['dirs']['warehouse'])
+        andrew = steward.Steward(stocker, clerk)
+        andrew._rabbit = MemoryRabbit()
+
+        # Time the stages of the process.
+        watch = Stopwatch()
+        watch.wrap(stocker, 'get_fingerprint', 'fingerprint')
+        watch.wrap(stocker, 'receive', 'receive')
+        watch.wrap(stocker, 'stock', 'stock')
+        watch.wrap(clerk, 'check_fingerprint', 'check_fingerprint')
+        watch.wrap(clerk, 'check_existence_many', 'check_existence')
+        watch.wrap(andrew, 'get_raw_tags', 'raw_tags')
+        watch.wrap(andrew, 'get_manual_tags', 'manual_tags')
+
+        # Time every file from its delivery to its report. The record is
+        # written in bulk on another thread, and only then is the file
+        # cleaned up and reported.
+        delivered = {}
+        callback = andrew.callback
+
+        def timed_callback(ch, method, properties, body):
+            delivered[method.delivery_tag] = time.perf_counter()
+            callback(ch, method, properties, body)
+
+        andrew.callback = timed_callback
+
+        # Count the outcome of every file.
+        outcomes = defaultdict(int)
+        report = andrew.report
+
+        def counted_report(ch, delivery_tag, body, attempts, succeed,
+                           record_id, retry=False):
+            watch.lap('end_to_end',
+                      time.perf_counter() - delivered.pop(delivery_tag))
+            outcomes["logged" if succeed else "retried" if retry
+                     else "rejected"] += 1
+            report(ch, delivery_tag, body, attempts, succeed, record_id, retry)
+
+        andrew.report = counted_report
+
+        channel = MemoryChannel(andrew._rabbit,
+                                args.workers + cfg['mongodb']['bulk']['size'])
+        andrew._rabbit.speak_many(files)
+        start = time.perf_counter()
+        channel.consume(andrew.callback)
+        clerk.flush()
+        elapsed = time.perf_counter() - start
+
+        result = {"scenario": args.scenario,
+                  "files": len(files),
+                  "bytes": num_bytes,
+                  "workers": args.workers,
+                  "seconds": elapsed,
+                  "files_per_second": len(files) / elapsed,
+                  "mb_per_second": num_bytes / elapsed / 1024 / 1024,
+                  "peak_rss_mb": resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "outcomes": dict(outcomes),
+                  "placement": dict(stocker.stats),
+                  "stages": watch.summary()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report_json = json.dumps(result, indent=2)
+    print(report_json)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""In-process stand-ins for the services Dwarf depends on."""
+
+import itertools
+import queue
+import threading
+import time
+
+
+class MemoryClerk:
+
+    def __init__(self):
+        """A clerk keeping the books in memory instead of MongoDB."""
+        self._books = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _collection(self, collection):
+        return self._books.setdefault(collection, {"hashes": {},
+                                                   "fingerprints": set()})
+
+    def check_fingerprint(self, file_size, fingerprint, collection):
+        with self._lock:
+            return (file_size, fingerprint) in \
+                self._collection(collection)["fingerprints"]
+
+    def check_existence_many(self, hash_values, collection):
+        with self._lock:
+            hashes = self._collection(collection)["hashes"]
+            return set(h for h in hash_values if h in hashes)
+
+    def file_a_record(self, record, collection, callback):
+        with self._lock:
+            books = self._collection(collection)
+            duplicated = record["hash"] in books["hashes"]
+            if not duplicated:
+                record["_id"] = next(self._ids)
+                books["hashes"][record["hash"]] = record
+                books["fingerprints"].add((record["file_size"],
+                                           record["fingerprint"]))
+        if duplicated:
+            callback(False, None, True)
+        else:
+            callback(True, record["_id"], False)
+
+    def flush(self):
+        pass
+
+
+class MemoryRabbit:
+
+    def __init__(self):
+        """A rabbit delivering the messages through an in-memory queue."""
+        self.messages = queue.Queue()
+
+    def speak(self, message):
+        return self.speak_many([message])
+
+    def speak_many(self, messages):
+        for message in messages:
+            self.messages.put((message, 0))
+        return True
+
+    def postpone(self, message, attempts):
+        self.messages.put((message, attempts))
+
+
+class Method:
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class Properties:
+
+    def __init__(self, attempts):
+        self.headers = {'x-attempts': attempts}
+
+
+class MemoryChannel:
+
+    def __init__(self, rabbit, max_unacked):
+        """A channel delivering the messages of the rabbit to a consumer.
+
+        Args:
+            rabbit: a MemoryRabbit.
+            max_unacked: the prefetch count.
+        """
+        self.rabbit = rabbit
+        self.connection = self
+        self._slots = threading.Semaphore(max_unacked)
+        self._lock = threading.Lock()
+        self._tags = itertools.count(1)
+        self._unacked = 0
+
+    def add_callback_threadsafe(self, callback):
+        with self._lock:
+            callback()
+
+    def basic_ack(self, delivery_tag):
+        self._unacked -= 1
+        self._slots.release()
+
+    def consume(self, callback, idle_timeout=1.0):
+        """Deliver the messages until the queue is drained and all acked."""
+        while True:
+            try:
+                body, attempts = self.rabbit.messages.get(timeout=0.05)
+            except queue.Empty:
+                with self._lock:
+                    if self._unacked == 0 and self.rabbit.messages.empty():
+                        return
+                continue
+
+            self._slots.acquire()
+            with self._lock:
+                self._unacked += 1
+            callback(self, Method(next(self._tags)), Properties(attempts),
+                     body.encode() if isinstance(body, str) else body)
+
+
+def fake_probe(video_path):
+    """Return the tags of a video without forking ffprobe."""
+    time.sleep(0.001)
+    return {"format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2"},
+            "streams": [{"codec_type": "video", "codec_name": "h264"}]}
@@ -0,0 +1,148 @@
+"""Query the records and export them, on the command line or over HTTP."""
+
+import csv
+import io
+import json
+import logging
+import logging.config
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import yaml
+
+from clerk import DEFAULT_FIELDS
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('clerk')
+
+
+def split_words(text):
+    """Split a list of words separated by commas."""
+    return [word for word in text.split(',') if word]
+
+
+# The filters of `Clerk.find_records`, and how to read them from text.
+FILTERS = {'tags': split_words,
+           'authors': split_words,
+           'codec': str,
+           'min_width': int,
+           'max_width': int,
+           'min_height': int,
+           'max_height': int,
+           'min_duration': float,
+           'max_duration': float}
+
+FORMATS = ('jsonl', 'csv')
+
+
+def parse_filters(params):
+    """Read the filters from a dict of text, like the query string.
+
+    A `ValueError` is raised if any of them is malformed.
+    """
+    return {key: FILTERS[key](value) for key, value in params.items()
+            if key in FILTERS and value not in (None, '')}
+
+
+def _cell(value):
+    """Format a value for a CSV cell. Lists are joined by spaces, just like
+    the tag files."""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ' '.join(str(item) for item in value)
+    return str(value)
+
+
+def export(records, out, fmt='jsonl', fields=DEFAULT_FIELDS):
+    """Write the records into the text stream one by one as they come.
+
+    Args:
+        records: an iterable of records, like a cursor.
+        out: the text stream.
+        fmt: `jsonl` or `csv`.
+        fields: the columns of the CSV, after `_id`.
+
+    Returns:
+        how many records are written.
+    """
+    num_records = 0
+    if fmt == 'csv':
+        columns = ['_id'] + [field for field in fields if field != '_id']
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow([_cell(record.get(column)) for column in columns])
+            num_records += 1
+    else:
+        for record in records:
+            out.write(json.dumps(record, default=str, ensure_ascii=False))
+            out.write("\n")
+            num_records += 1
+
+    return num_records
+
+
+def serve(clerk, collections, port, address='127.0.0.1'):
+    """Serve the records at http://address:port/records/<kind> until killed.
+
+    The filters, `fields`, `after`, `limit` and `format` are given in the
+    query string, like `/records/videos?codec=h264&min_width=1920`. The
+    records are streamed, so the whole collection could be exported at once.
+
+    Args:
+        clerk: a clerk to find the records.
+        collections: a dict of the collection names by kind.
+        port: the port.
+        address: the address to listen at.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'records' \
+                    or parts[1] not in collections:
+                self.send_error(404)
+                return
+
+            params = dict(parse_qsl(url.query))
+            fmt = params.get('format', 'jsonl')
+            fields = split_words(params['fields']) if params.get('fields') \
+                else DEFAULT_FIELDS
+            try:
+                filters = parse_filters(params)
+                records = clerk.find_records(collections[parts[1]],
+                                             fields=fields,
+                                             after=params.get('after'),
+                                             limit=int(params.get('limit', 0)),
+                                             **filters)
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+            if fmt not in FORMATS:
+                self.send_error(400, "Unknown format: {}".format(fmt))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv' if fmt == 'csv'
+                             else 'application/x-ndjson')
+            self.end_headers()
+            out = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='',
+                                   write_through=True)
+            try:
+                export(records, out, fmt, fields)
+                out.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                logger.debug("The client left before the export finished.")
+            finally:
+                out.detach()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    logger.info("[*] Records served at http://{}:{}/records/".format(
+        address, port))
+    server.serve_forever()
@@ -1,34 +1,149 @@
+import datetime
 import logging
 import logging.config
+import threading
+import time
+
 import yaml
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from pymongo import MongoClient
+from lookalike import LookalikeIndex
 
 # Setup the logger.
 logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
 logger = logging.getLogger('clerk')
 
+# The error code MongoDB uses for a unique index violation.
+DUPLICATE_KEY = 11000
+
+# The collection of the files being processed, and by which node.
+LEASES = "leases"
+
+# A painting may be committed a while after the paint time the server gave
+# it. Those painted this long before the latest one are read again.
+LOOKALIKE_LAG = datetime.timedelta(seconds=60)
+
+# The clients shared in this process, by the server and the account.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(address, port, username, password, name, pool_size=100):
+    """Return the MongoDB client shared by all the clerks of this process.
+
+    A client is thread safe and keeps a pool of connections. Every worker
+    borrows one only while talking to the server, so one client is enough
+    for all of them.
+    """
+    key = (address, port, username, name)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = MongoClient(address, port,
+                                        username=username,
+                                        password=password,
+                                        authSource=name,
+                                        maxPoolSize=pool_size)
+        return _clients[key]
+
+# The fields returned by a query if not asked otherwise. The raw tags are
+# left out, as they are large and the useful parts are flattened at ingest.
+DEFAULT_FIELDS = ('base_name', 'path', 'hash', 'file_size', 'index_time',
+                  'manual_tags', 'authors', 'format', 'codec', 'width',
+                  'height', 'duration')
+
 
 class Clerk:
 
-    def __init__(self, address, port, username, password, name):
+    def __init__(self, address, port, username, password, name, collections=(),
+                 bulk_size=1, bulk_interval=1.0, lookalike_interval=10.0,
+                 pool_size=100):
         """Initialize a MongoDB client.
 
         Args:
             address: the host address, like `localhost`
             port: the port.
             name: the database name
+            collections: the collections to be indexed.
+            bulk_size: how many records to buffer before writing them at once.
+            bulk_interval: the longest time in seconds a record is buffered.
+            lookalike_interval: how many seconds before the lookalike index
+                is refreshed with the records painted by other processes.
+            pool_size: the most connections to the server. It should be no
+                fewer than the workers talking to the database at once.
         """
-        self.client = MongoClient(address, port,
-                                  username=username,
-                                  password=password,
-                                  authSource=name)
+        self.client = get_client(address, port, username, password, name,
+                                 pool_size)
         self.db = self.client.get_database(name)
         try:
             self.db.get_collection("images").find_one()
         except:
             logger.error("Failed to read database, please check.")
 
+        for collection in collections:
+            self.create_indexes(collection)
+
+        # The expired leases are cleaned by the database itself.
+        try:
+            self.db.get_collection(LEASES).create_index(
+                [('expires', ASCENDING)], expireAfterSeconds=0)
+        except:
+            logger.error("Failed to create indexes for leases, please check.")
+
+        # Records waiting to be written in bulk, grouped by collection.
+        self._bulk_size = bulk_size
+        self._bulk_interval = bulk_interval
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        if self._bulk_size > 1:
+            threading.Thread(target=self._flush_periodically,
+                             name='clerk-flush',
+                             daemon=True).start()
+
+        # The perceptual hashes of every collection, with the paint time of
+        # the latest record loaded and the time of the last refresh.
+        self._lookalike_interval = lookalike_interval
+        self._lookalikes = {}
+        self._lookalike_lock = threading.Lock()
+
+    def create_indexes(self, collection):
+        """Make sure the indexes of the collection exist.
+
+        The hash index is unique, so the database itself rejects a duplicated
+        file even if two workers try to insert it at the same time.
+        """
+        books = self.db.get_collection(collection)
+
+        # Without the unique index, duplicated files are no longer rejected.
+        # It fails on a collection that already holds duplicated hashes.
+        try:
+            books.create_index([('hash', ASCENDING)], unique=True)
+        except:
+            logger.critical(
+                "Failed to create the unique hash index for {}. Duplicated files "
+                "will NOT be rejected. Remove the duplicated records and start "
+                "again.".format(collection))
+
+        # The queries are paged by `_id`, so it ends every compound index a
+        # query may be filtered by. Each index is tried on its own.
+        for keys, options in (
+                ([('index_time', ASCENDING)], {}),
+                ([('manual_tags', ASCENDING)], {}),
+                ([('authors', ASCENDING)], {}),
+                ([('file_size', ASCENDING), ('fingerprint', ASCENDING)], {}),
+                ([('paint_time', ASCENDING)], {'sparse': True}),
+                ([('manual_tags', ASCENDING), ('_id', ASCENDING)], {}),
+                ([('authors', ASCENDING), ('_id', ASCENDING)], {}),
+                ([('codec', ASCENDING), ('_id', ASCENDING)], {}),
+                ([('width', ASCENDING), ('height', ASCENDING)], {}),
+                ([('duration', ASCENDING)], {})):
+            try:
+                books.create_index(keys, **options)
+            except:
+                logger.error("Failed to create index {} for {}, please "
+                             "check.".format(keys, collection))
+
     def set_collection(self, name):
         """Get the collection by name"""
         self.collection = self.db.get_collection(name)
@@ -44,6 +159,230 @@ class Clerk:
             {'hash': hash_value})
         return True if exists else False
 
-    def keep_a_record(self, record):
-        """Insert a record into the current collection."""
-        return self.collection.insert_one(record).inserted_id
+    def check_fingerprint(self, file_size, fingerprint, collection):
+        """Check if any record in the collection has the same fingerprint."""
+        exists = self.db.get_collection(collection).find_one(
+            {'file_size': file_size, 'fingerprint': fingerprint}, {'_id': 1})
+        return True if exists else False
+
+    def check_existence_many(self, hash_values, collection):
+        """Check which of the hash values existed in the collection.
+
+        Returns:
+            a set of the hash values already recorded.
+        """
+        cursor = self.db.get_collection(collection).find(
+            {'hash': {'$in': list(hash_values)}}, {'_id': 0, 'hash': 1})
+        return set(doc['hash'] for doc in cursor)
+
+    def list_records(self, collection, projection=None, query=None):
+        """Return a cursor over the records of the collection."""
+        return self.db.get_collection(collection).find(query or {}, projection)
+
+    def find_records(self, collection, tags=None, authors=None, codec=None,
+                     min_width=None, max_width=None, min_height=None,
+                     max_height=None, min_duration=None, max_duration=None,
+                     fields=DEFAULT_FIELDS, after=None, limit=0):
+        """Find the records matching all the filters, in the order of `_id`.
+
+        The results are paged by a cursor instead of skipping: pass the `_id`
+        of the last record got as `after` to get the next page.
+
+        Args:
+            collection: the collection name.
+            tags: the records must have all these manual tags.
+            authors: the records must have any of these authors.
+            codec: the video codec, like `h264`.
+            min_width, max_width, min_height, max_height: the dimensions in
+                pixels.
+            min_duration, max_duration: the duration in seconds.
+            fields: the fields to return, `_id` included.
+            after: only the records after this `_id`, in hex digits.
+            limit: the most records to return, no limit if 0.
+
+        Returns:
+            a cursor over the records.
+        """
+        query = {}
+        if tags:
+            query['manual_tags'] = {'$all': list(tags)}
+        if authors:
+            query['authors'] = {'$in': list(authors)}
+        if codec:
+            query['codec'] = codec
+        for field, lowest, highest in (('width', min_width, max_width),
+                                       ('height', min_height, max_height),
+                                       ('duration', min_duration, max_duration)):
+            bounds = {}
+            if lowest is not None:
+                bounds['$gte'] = lowest
+            if highest is not None:
+                bounds['$lte'] = highest
+            if bounds:
+                query[field] = bounds
+        if after:
+            query['_id'] = {'$gt': ObjectId(after)}
+
+        return self.db.get_collection(collection).find(
+            query, list(fields) if fields else None).sort(
+                '_id', ASCENDING).limit(limit)
+
+    def update_record(self, record_id, collection, fields, stamp=None):
+        """Set the fields of the record.
+
+        If `stamp` is given, that field is set to the time of the database
+        server, which does not depend on the clock of this node.
+        """
+        update = {'$set': fields}
+        if stamp is not None:
+            update['$currentDate'] = {stamp: True}
+        self.db.get_collection(collection).update_one({'_id': record_id},
+                                                      update)
+
+    def find_similar(self, phash, max_distance, collection):
+        """Find the records that look like the perceptual hash.
+
+        Args:
+            phash: the perceptual hash in hex digits.
+            max_distance: the largest Hamming distance allowed.
+            collection: the collection name.
+
+        Returns:
+            a list of (record_id, distance), the nearest first.
+        """
+        with self._lookalike_lock:
+            index = self._refresh_lookalikes(collection)
+            return index.find(phash, max_distance)
+
+    def remember_lookalike(self, record_id, collection, phash):
+        """Put a freshly painted record in the lookalike index."""
+        with self._lookalike_lock:
+            index = self._refresh_lookalikes(collection)
+            index.add(record_id, phash)
+
+    def _refresh_lookalikes(self, collection):
+        """Load the records painted since the last refresh into the index.
+
+        Only the new records are read, so the index is loaded once and then
+        kept up with at little cost. The paint time is given by the server,
+        and a lag window before the latest one is read again, so the records
+        committed out of order are not missed.
+        """
+        index, painted_since, refreshed_at = self._lookalikes.get(
+            collection, (LookalikeIndex(), None, None))
+        now = time.monotonic()
+        if refreshed_at is not None and \
+                now - refreshed_at < self._lookalike_interval:
+            return index
+
+        query = {'phash': {'$exists': True}}
+        if painted_since is not None:
+            query['paint_time'] = {'$gte': painted_since - LOOKALIKE_LAG}
+        try:
+            cursor = self.db.get_collection(collection).find(
+                query, {'phash': 1, 'paint_time': 1})
+            for doc in cursor:
+                index.add(doc['_id'], doc['phash'])
+                if doc.get('paint_time') and (painted_since is None
+                                              or doc['paint_time'] > painted_since):
+                    painted_since = doc['paint_time']
+        except:
+            logger.error("Failed to load the lookalikes of {}.".format(collection))
+
+        self._lookalikes[collection] = (index, painted_since, now)
+        return index
+
+    def acquire_lease(self, key, owner, ttl):
+        """Take the lease of the key for `ttl` seconds.
+
+        The lease could be taken if nobody holds it, it has expired, or the
+        owner already holds it. The check and the update are done at once by
+        the database, so only one owner wins.
+
+        Returns:
+            True if the lease is taken by the owner.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            self.db.get_collection(LEASES).find_one_and_update(
+                {'_id': key,
+                 '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner,
+                          'expires': now + datetime.timedelta(seconds=ttl)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def renew_leases(self, keys, owner, ttl):
+        """Extend the leases of the keys the owner still holds by `ttl`
+        seconds from now."""
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        self.db.get_collection(LEASES).update_many(
+            {'_id': {'$in': list(keys)}, 'owner': owner},
+            {'$set': {'expires': expires}})
+
+    def release_lease(self, key, owner):
+        """Give up the lease of the key, if the owner holds it."""
+        self.db.get_collection(LEASES).delete_one({'_id': key, 'owner': owner})
+
+    def file_a_record(self, record, collection, callback):
+        """Buffer a record to be inserted into the collection in bulk.
+
+        The buffer is written once it is full or has waited long enough.
+
+        Args:
+            record: the record to be inserted.
+            collection: the collection name.
+            callback: called with (succeed, record_id, duplicated) once the
+                record is written or rejected. It may run on another thread.
+        """
+        with self._pending_lock:
+            batch = self._pending.setdefault(collection, [])
+            batch.append((record, callback))
+            if len(batch) < self._bulk_size:
+                return
+            del self._pending[collection]
+
+        self._write(collection, batch)
+
+    def flush(self):
+        """Write all the buffered records."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+
+        for collection, batch in pending.items():
+            self._write(collection, batch)
+
+    def _flush_periodically(self):
+        """Make sure no record waits in the buffer for too long."""
+        while True:
+            time.sleep(self._bulk_interval)
+            self.flush()
+
+    def _write(self, collection, batch):
+        """Insert a batch of records and report the result of each one."""
+        records = [record for record, _ in batch]
+        errors = {}
+
+        # An unordered insert keeps going after a failure, so one duplicated
+        # file does not hold back the rest of the batch.
+        try:
+            self.db.get_collection(collection).insert_many(records,
+                                                           ordered=False)
+        except BulkWriteError as e:
+            errors = {error['index']: error['code']
+                      for error in e.details['writeErrors']}
+        except:
+            logger.error("Failed to write {} records into {}.".format(
+                len(records), collection))
+            errors = {index: None for index in range(len(records))}
+
+        for index, (record, callback) in enumerate(batch):
+            try:
+                if index in errors:
+                    callback(False, None, errors[index] == DUPLICATE_KEY)
+                else:
+                    callback(True, record['_id'], False)
+            except:
+                logger.exception("Failed to report the record.")
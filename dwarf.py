@@ -0,0 +1,399 @@
+"""Maintenance commands of Dwarf.
+
+Usage:
+    python3 dwarf.py config.yml reshard [--workers N]
+    python3 dwarf.py config.yml rehash [--workers N]
+    python3 dwarf.py config.yml import DIR [--workers N] [--checkpoint FILE]
+    python3 dwarf.py config.yml fsck [--workers N] [--grace SECONDS] [--fix]
+    python3 dwarf.py config.yml flatten [--workers N]
+    python3 dwarf.py config.yml query KIND [filters] [--format jsonl|csv]
+    python3 dwarf.py config.yml serve [--port PORT] [--address ADDRESS]
+"""
+import argparse
+import functools
+import glob
+import logging
+import logging.config
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+from pymongo.errors import DuplicateKeyError
+
+import catalogue
+from clerk import DEFAULT_FIELDS, Clerk
+from journal import JOURNAL_FILES, replay
+from scout import Logbook, Scout
+from steward import Steward, get_flat_tags
+from stocker import DOCK, RACK, Stocker
+
+# Load the configuration file.
+CFG_FILE = sys.argv[1] if len(sys.argv) > 1 else 'config.yml'
+with open(CFG_FILE, 'r') as f:
+    CFG = yaml.load(f, Loader=yaml.FullLoader)
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('root')
+
+
+def employ_clerk():
+    """Employ a clerk to manage the books."""
+    return Clerk(CFG['mongodb']["host"],
+                 CFG['mongodb']['port'],
+                 CFG['mongodb']['username'],
+                 CFG['mongodb']['password'],
+                 CFG["mongodb"]['name'],
+                 CFG["mongodb"]['collections'].values(),
+                 CFG["mongodb"]['bulk']['size'],
+                 CFG["mongodb"]['bulk']['interval'],
+                 pool_size=CFG["mongodb"]['pool_size'])
+
+
+def employ_stocker():
+    """Employ a stocker to look after the warehouse."""
+    return Stocker(CFG['dirs']['barn'], CFG['dirs']['warehouse'])
+
+
+def run_in_parallel(pool, func, items, max_pending=1024):
+    """Run the function on every item in the pool, yields the results.
+
+    Only a limited number of items are submitted at a time, so the items
+    could come from a cursor of any length.
+    """
+    pending = set()
+    for item in items:
+        pending.add(pool.submit(func, item))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from (future.result() for future in done)
+    done, _ = wait(pending)
+    yield from (future.result() for future in done)
+
+
+def reshard(args):
+    """Move the stocked files to the shard layout in the config file.
+
+    Each file is linked to its new path before the record is updated, and
+    the old path is removed only after that. So the file is always available
+    while the daemon keeps running.
+    """
+    stocker = employ_stocker()
+    clerk = employ_clerk()
+
+    def move(collection, record):
+        try:
+            new_path = stocker.restock(record['path'])
+            if new_path == record['path']:
+                return False
+            clerk.update_record(record['_id'], collection, {'path': new_path})
+            stocker.destry(record['path'])
+            return True
+        except:
+            logger.exception("{}: Failed to move file.".format(record['path']))
+            return False
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for collection in CFG['mongodb']['collections'].values():
+            records = clerk.list_records(collection, {'path': 1})
+            num_moved = sum(run_in_parallel(
+                pool, functools.partial(move, collection), records))
+            logger.info("{}: {} files moved.".format(collection, num_moved))
+
+
+def rehash(args):
+    """Hash the recorded files again with the algorithm in the config file.
+
+    The files keep their names, only the records are updated. Once it is done
+    the legacy algorithms could be removed from the config file.
+    """
+    stocker = employ_stocker()
+    clerk = employ_clerk()
+    algo = stocker.algo
+
+    def update(collection, record):
+        succeed, digests = stocker.get_checksum(record['path'], [algo])
+        if not succeed:
+            logger.warning("{}: Failed to hash file.".format(record['path']))
+            return False
+        try:
+            clerk.update_record(record['_id'], collection,
+                                {'hash': digests[algo], 'algo': algo})
+        except DuplicateKeyError:
+            logger.warning("{}: Duplicated file.".format(record['path']))
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for collection in CFG['mongodb']['collections'].values():
+            records = clerk.list_records(collection, {'path': 1},
+                                         {'algo': {'$ne': algo}})
+            num_updated = sum(run_in_parallel(
+                pool, functools.partial(update, collection), records))
+            logger.info("{}: {} records updated.".format(collection, num_updated))
+
+
+def import_files(args):
+    """Import the files in a directory without going through the queue.
+
+    The files are processed by the steward just like those in the barn, and
+    the records are written in bulk. The files imported or rejected are
+    written down in a checkpoint, so an interrupted import could be run again
+    without hashing them twice.
+    """
+    stocker = employ_stocker()
+    clerk = employ_clerk()
+    steward = Steward(stocker, clerk, os.path.join(
+        CFG['dirs']['warehouse'], 'import-journal.log'))
+    steward.recover()
+
+    # The directory takes the place of the barn, tag files included.
+    steward.barn = args.dir
+    checkpoint = Logbook(args.checkpoint or os.path.join(
+        CFG['dirs']['warehouse'], 'import.db'))
+
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    # Every file settled for good is written down, the rejected ones
+    # included, so none of them is hashed again. Only those to be tried
+    # again are left out.
+    def on_done(path, size, mtime, succeed, record_id, retry=False):
+        if not retry:
+            checkpoint.write_down(path, size, mtime)
+        with lock:
+            outcomes['imported' if succeed else 'retry' if retry
+                     else 'rejected'] += 1
+
+    def ingest(item):
+        path, size, mtime = item
+        try:
+            steward.process(path, functools.partial(on_done, path, size, mtime))
+        except:
+            logger.exception("{}: Unexpected error.".format(path))
+            on_done(path, size, mtime, False, None)
+
+    def fresh_files():
+        for path, size, mtime in Scout(CFG['stocker']['walkers']).explore(
+                args.dir):
+            if steward.is_secret_mission(path) or steward.is_tag_file(path):
+                continue
+            if checkpoint.is_new(path, size, mtime):
+                yield path, size, mtime
+            else:
+                with lock:
+                    outcomes['skipped'] += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for _ in run_in_parallel(pool, ingest, fresh_files()):
+                pass
+        clerk.flush()
+    finally:
+        checkpoint.close()
+
+    logger.info("{}: {} files imported, {} rejected, {} to be tried again, "
+                "{} skipped.".format(args.dir, outcomes['imported'],
+                                     outcomes['rejected'], outcomes['retry'],
+                                     outcomes['skipped']))
+
+
+def fsck(args):
+    """Reconcile the warehouse with the records.
+
+    The warehouse is walked while the records are read, all at the same time.
+    Files without a record are orphans left by a crash, and are removed if
+    asked to. Records without a file are only reported. Files stocked in the
+    grace period, or found in the journals, may still be in process and are
+    left alone.
+    """
+    stocker = employ_stocker()
+    clerk = employ_clerk()
+    collections = list(CFG['mongodb']['collections'].values())
+
+    def read_paths(collection):
+        return collection, set(record['path'] for record in clerk.list_records(
+            collection, {'_id': 0, 'path': 1}))
+
+    with ThreadPoolExecutor(max_workers=max(args.workers,
+                                            len(collections))) as pool:
+        readers = [pool.submit(read_paths, collection)
+                   for collection in collections]
+
+        stocked = set()
+        scout = Scout(args.workers)
+        for rack in (RACK, DOCK):
+            for path, _, _ in scout.explore(
+                    os.path.join(stocker.warehouse, rack)):
+                stocked.add(path)
+
+        recorded = {}
+        for reader in readers:
+            collection, paths = reader.result()
+            recorded.update((path, collection) for path in paths)
+
+        # The files docked or stocked but not cleaned yet by any steward.
+        in_process = set()
+        for journal_file in glob.glob(os.path.join(stocker.warehouse,
+                                                   JOURNAL_FILES)):
+            for entry in replay(journal_file).values():
+                in_process.update(entry[key] for key in ('docked', 'dst')
+                                  if key in entry)
+
+        # A stocked file keeps the modification time of the source, so its
+        # age is told by the change time, which is reset by stocking.
+        deadline = time.time_ns() - int(args.grace * 1e9)
+
+        def is_orphan(path):
+            if path in recorded or path in in_process:
+                return False
+            try:
+                return os.stat(path).st_ctime_ns < deadline
+            except OSError:
+                return False
+
+        orphans = [path for path in stocked if is_orphan(path)]
+        for path in orphans:
+            logger.warning("{}: File not recorded.".format(path))
+        missing = [(path, collection) for path, collection in recorded.items()
+                   if path not in stocked]
+        for path, collection in missing:
+            logger.warning("{}: File of the record in {} not found.".format(
+                path, collection))
+
+        num_removed = 0
+        if args.fix:
+            num_removed = sum(run_in_parallel(pool, stocker.destry, orphans))
+
+    logger.info("{} files checked, {} records checked, {} orphans found, {} "
+                "removed, {} files missing.".format(
+                    len(stocked), len(recorded), len(orphans), num_removed,
+                    len(missing)))
+
+
+def flatten(args):
+    """Extract the flat tags of the records written before they existed."""
+    clerk = employ_clerk()
+
+    def update(collection, record):
+        clerk.update_record(record['_id'], collection,
+                            get_flat_tags(record.get('raw_tag') or {}))
+        return True
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for collection in CFG['mongodb']['collections'].values():
+            records = clerk.list_records(collection, {'raw_tag': 1},
+                                         {'format': {'$exists': False}})
+            num_updated = sum(run_in_parallel(
+                pool, functools.partial(update, collection), records))
+            logger.info("{}: {} records updated.".format(collection, num_updated))
+
+
+def query(args):
+    """Find the records and export them as JSON lines or CSV.
+
+    The records are written as they come from the database, so the output
+    could be of any size.
+    """
+    clerk = employ_clerk()
+    fields = catalogue.split_words(args.fields) if args.fields else DEFAULT_FIELDS
+    filters = catalogue.parse_filters(
+        {key: getattr(args, key) for key in catalogue.FILTERS})
+    records = clerk.find_records(CFG['mongodb']['collections'][args.kind],
+                                 fields=fields, after=args.after,
+                                 limit=args.limit, **filters)
+
+    if args.output == '-':
+        catalogue.export(records, sys.stdout, args.format, fields)
+        return
+
+    with open(args.output, 'w', newline='') as f:
+        num_records = catalogue.export(records, f, args.format, fields)
+    logger.info("{} records written into {}.".format(num_records, args.output))
+
+
+def serve(args):
+    """Serve the records over HTTP."""
+    catalogue.serve(employ_clerk(), CFG['mongodb']['collections'], args.port,
+                    args.address)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands of Dwarf.")
+    parser.add_argument('config', help="the configuration file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_reshard = commands.add_parser(
+        'reshard', help="move the stocked files to the current shard layout")
+    parser_reshard.add_argument('--workers', type=int, default=8,
+                                help="how many files to move in parallel")
+    parser_reshard.set_defaults(func=reshard)
+
+    parser_rehash = commands.add_parser(
+        'rehash', help="hash the recorded files with the current algorithm")
+    parser_rehash.add_argument('--workers', type=int, default=8,
+                               help="how many files to hash in parallel")
+    parser_rehash.set_defaults(func=rehash)
+
+    parser_import = commands.add_parser(
+        'import', help="import the files in a directory without the queue")
+    parser_import.add_argument('dir', help="the directory to import")
+    parser_import.add_argument('--workers', type=int, default=8,
+                               help="how many files to import in parallel")
+    parser_import.add_argument('--checkpoint',
+                               help="the file to remember the imported files, "
+                                    "import.db in the warehouse by default")
+    parser_import.set_defaults(func=import_files)
+
+    parser_fsck = commands.add_parser(
+        'fsck', help="reconcile the warehouse with the records")
+    parser_fsck.add_argument('--workers', type=int, default=8,
+                             help="how many directories to walk in parallel")
+    parser_fsck.add_argument('--grace', type=float, default=3600,
+                             help="seconds a file may stay unrecorded")
+    parser_fsck.add_argument('--fix', action='store_true',
+                             help="remove the files not recorded")
+    parser_fsck.set_defaults(func=fsck)
+
+    parser_flatten = commands.add_parser(
+        'flatten', help="extract the flat tags of the old records")
+    parser_flatten.add_argument('--workers', type=int, default=8,
+                                help="how many records to update in parallel")
+    parser_flatten.set_defaults(func=flatten)
+
+    parser_query = commands.add_parser(
+        'query', help="find the records and export them")
+    parser_query.add_argument('kind', choices=list(CFG['mongodb']['collections']),
+                              help="which kind of files to find")
+    parser_query.add_argument('--tags', help="all of the tags, like `a,b`")
+    parser_query.add_argument('--authors', help="any of the authors, like `a,b`")
+    parser_query.add_argument('--codec', help="the video codec, like `h264`")
+    for bound in ('min', 'max'):
+        for field in ('width', 'height', 'duration'):
+            parser_query.add_argument('--{}-{}'.format(bound, field),
+                                      help="the {} {}".format(bound, field))
+    parser_query.add_argument('--fields',
+                              help="the fields to return, like `path,hash`")
+    parser_query.add_argument('--after',
+                              help="only the records after this `_id`")
+    parser_query.add_argument('--limit', type=int, default=0,
+                              help="the most records to return")
+    parser_query.add_argument('--format', choices=catalogue.FORMATS,
+                              default='jsonl', help="the output format")
+    parser_query.add_argument('--output', default='-',
+                              help="the output file, stdout by default")
+    parser_query.set_defaults(func=query)
+
+    parser_serve = commands.add_parser('serve', help="serve the records over HTTP")
+    parser_serve.add_argument('--port', type=int, default=9109,
+                              help="the port to listen at")
+    parser_serve.add_argument('--address', default='127.0.0.1',
+                              help="the address to listen at")
+    parser_serve.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    args.func(args)
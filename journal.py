@@ -0,0 +1,150 @@
+"""An append-only journal of the files being processed.
+
+Every file goes through the states `hashed`, `stocked`, `recorded` and
+`cleaned`. The entries are written in groups, each with a single fsync, so
+the journal costs little more than the memory it takes. After a crash the
+files not cleaned yet are found in it and could be settled without hashing
+anything again.
+"""
+
+import fcntl
+import json
+import logging
+import logging.config
+import os
+import threading
+import time
+
+import yaml
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('steward')
+
+HASHED = "hashed"
+STOCKED = "stocked"
+RECORDED = "recorded"
+CLEANED = "cleaned"
+
+# The journals of all the processes sharing the warehouse.
+JOURNAL_FILES = "*journal*.log"
+
+
+def replay(journal_file):
+    """Return the last entry of every file not cleaned, keyed by path."""
+    entries = {}
+    try:
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short by the crash.
+                    continue
+                if entry['state'] == CLEANED:
+                    entries.pop(entry['path'], None)
+                else:
+                    entries[entry['path']] = entry
+    except FileNotFoundError:
+        pass
+
+    return entries
+
+
+class Journal:
+
+    def __init__(self, journal_file, commit_interval=0.05, max_size=64 * 1024 * 1024):
+        """Open the journal, and find the unfinished files in it.
+
+        A journal belongs to a single process. A `RuntimeError` is raised if
+        another process holds it.
+
+        Args:
+            journal_file: the file to keep the entries.
+            commit_interval: how many seconds the entries wait to be committed
+                together.
+            max_size: the journal is rewritten with only the unfinished files
+                once it grows larger than this in bytes.
+        """
+        self.journal_file = journal_file
+
+        # The journal itself is replaced on every rewrite, so the lock is
+        # taken on a file of its own, and held until the process exits.
+        self._lock_file = open(journal_file + ".lock", 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise RuntimeError("{} is used by another process. Give every "
+                               "steward a node name of its own.".format(
+                                   journal_file)) from None
+
+        self.max_size = max_size
+        self._pending = []
+        self._open = replay(journal_file)
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+
+        # Start afresh with the unfinished files only.
+        self._file = None
+        self._rewrite(list(self._open.values()))
+
+        threading.Thread(target=self._commit_periodically,
+                         args=(commit_interval,),
+                         name='journal-commit',
+                         daemon=True).start()
+
+    def unfinished(self):
+        """Return the last entries of the files not cleaned yet."""
+        with self._lock:
+            return list(self._open.values())
+
+    def write(self, path, state, **fields):
+        """Write down the state of the file. It is committed with the others
+        in the next group."""
+        entry = dict(fields, path=path, state=state)
+        with self._lock:
+            self._pending.append(json.dumps(entry))
+            if state == CLEANED:
+                self._open.pop(path, None)
+            else:
+                self._open[path] = entry
+
+    def commit(self):
+        """Write the pending entries and sync them to the disk at once."""
+        with self._commit_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if not lines:
+                return
+
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            if self._file.tell() > self.max_size:
+                self._rewrite(self.unfinished())
+
+    def _rewrite(self, entries):
+        """Replace the journal with the entries. The caller should hold the
+        commit lock, unless there is no other thread yet."""
+        temp_file = self.journal_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.journal_file)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_file, 'a')
+
+    def _commit_periodically(self, interval):
+        """Commit the entries in groups."""
+        while True:
+            time.sleep(interval)
+            try:
+                self.commit()
+            except OSError:
+                logger.exception("Failed to commit the journal.")
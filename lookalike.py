@@ -0,0 +1,86 @@
+"""An in-memory index of the perceptual hashes, searched by Hamming distance.
+
+The 64-bit hashes are cut into 4 chunks of 16 bits, and each chunk is indexed
+in a table of its own. Two hashes within a distance of `d` have at least one
+chunk within `d // 4` of each other, so only the entries sharing a chunk with
+one of its few neighbours have to be compared.
+"""
+
+import functools
+import itertools
+
+NUM_CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def _chunks(value):
+    """Cut the 64-bit value into chunks."""
+    return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(NUM_CHUNKS)]
+
+
+@functools.lru_cache(maxsize=None)
+def _masks(radius):
+    """Return the masks flipping no more than `radius` bits of a chunk."""
+    masks = []
+    for num_bits in range(radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), num_bits):
+            masks.append(sum(1 << bit for bit in bits))
+    return masks
+
+
+class LookalikeIndex:
+
+    def __init__(self):
+        """Index the perceptual hashes of the records by their chunks."""
+        self._hashes = {}
+        self._tables = [{} for _ in range(NUM_CHUNKS)]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, key, phash):
+        """Put the hash of the record in the index, or replace it.
+
+        Args:
+            key: the record ID.
+            phash: the perceptual hash in hex digits.
+        """
+        if key in self._hashes:
+            self.remove(key)
+
+        value = int(phash, 16)
+        self._hashes[key] = value
+        for table, chunk in zip(self._tables, _chunks(value)):
+            table.setdefault(chunk, []).append(key)
+
+    def remove(self, key):
+        """Take the record out of the index."""
+        value = self._hashes.pop(key)
+        for table, chunk in zip(self._tables, _chunks(value)):
+            keys = table[chunk]
+            keys.remove(key)
+            if not keys:
+                del table[chunk]
+
+    def find(self, phash, max_distance):
+        """Find the records within the distance of the hash.
+
+        Returns:
+            a list of (key, distance), the nearest first.
+        """
+        value = int(phash, 16)
+        masks = _masks(max_distance // NUM_CHUNKS)
+
+        candidates = set()
+        for table, chunk in zip(self._tables, _chunks(value)):
+            for mask in masks:
+                candidates.update(table.get(chunk ^ mask, ()))
+
+        found = []
+        for key in candidates:
+            distance = bin(self._hashes[key] ^ value).count('1')
+            if distance <= max_distance:
+                found.append((key, distance))
+
+        return sorted(found, key=lambda item: item[1])
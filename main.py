@@ -1,12 +1,20 @@
-"""Dwarf aggregate files of interest and stores detailed information in the 
+"""Dwarf aggregate files of interest and stores detailed information in the
 dataset.
+
+Usage:
+    python3 main.py config.yml [--role all|porter|steward] [--shards 0,1]
+                               [--node NAME] [--async]
 """
+import argparse
+import socket
 import sys
+import time
 import yaml
 import logging
 import logging.config
 
 from clerk import Clerk
+from metrics import METRICS
 from porter import Porter
 from stocker import Stocker
 from steward import Steward
@@ -21,33 +29,75 @@ logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
 logger = logging.getLogger('root')
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dwarf aggregates files of interest.")
+    parser.add_argument('config', nargs='?', default='config.yml',
+                        help="the configuration file, always the first argument")
+    parser.add_argument('--role', choices=['all', 'porter', 'steward'],
+                        default='all',
+                        help="watch the barn, process the files, or both")
+    parser.add_argument('--shards',
+                        help="the shards of the queue to process, like `0,1`. "
+                             "All of them by default.")
+    parser.add_argument('--node', default=socket.gethostname(),
+                        help="the name of this steward, unique among those "
+                             "sharing the warehouse. The host name by default.")
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help="run the steward on an asyncio event loop")
+    args = parser.parse_args()
 
     # Employ a porter to watch the barn for new files.
-    Jack = Porter(CFG['dirs']['barn'])
-    logger.info("Porter is ready.")
-
-    # Employ a stocker to fill the warehouse.
-    Tom = Stocker(CFG['dirs']['barn'],
-                  CFG['dirs']['warehouse'])
-    logger.info("Stocker is ready.")
-
-    # Employ a clerk to manage the books.
-    Julie = Clerk(CFG['mongodb']["host"],
-                  CFG['mongodb']['port'],
-                  CFG['mongodb']['username'],
-                  CFG['mongodb']['password'],
-                  CFG["mongodb"]['name'])
-    logger.info("Clark is ready.")
-
-    # Employ a steward to manage the entire process.
-    Andrew = Steward(Tom, Julie)
-    logger.info("Steward is ready.")
+    Jack = None
+    if args.role in ('all', 'porter'):
+        Jack = Porter(CFG['dirs']['barn'])
+        logger.info("Porter is ready.")
+
+    Andrew = None
+    if args.role in ('all', 'steward'):
+        # Employ a stocker to fill the warehouse.
+        Tom = Stocker(CFG['dirs']['barn'],
+                      CFG['dirs']['warehouse'],
+                      node=args.node)
+        logger.info("Stocker is ready.")
+
+        # Employ a clerk to manage the books.
+        Julie = Clerk(CFG['mongodb']["host"],
+                      CFG['mongodb']['port'],
+                      CFG['mongodb']['username'],
+                      CFG['mongodb']['password'],
+                      CFG["mongodb"]['name'],
+                      CFG["mongodb"]['collections'].values(),
+                      CFG["mongodb"]['bulk']['size'],
+                      CFG["mongodb"]['bulk']['interval'],
+                      pool_size=CFG["mongodb"]['pool_size'])
+        logger.info("Clark is ready.")
+
+        # Employ a steward to manage the entire process. The warehouse may be
+        # shared by the steward nodes, each keeping a journal of its own.
+        if args.async_mode:
+            from async_steward import AsyncSteward
+            Andrew = AsyncSteward(Tom, Julie, node=args.node)
+        else:
+            Andrew = Steward(Tom, Julie, node=args.node)
+        if args.shards:
+            Andrew.shards = [int(shard) for shard in args.shards.split(',')]
+        logger.info("Steward is ready.")
+
+        # Let people see how it goes.
+        if CFG['metrics']['port']:
+            METRICS.serve(CFG['metrics']['port'])
+        if CFG['metrics']['dump_interval']:
+            METRICS.dump_periodically(CFG['metrics']['dump_interval'])
 
     # Let the process begin.
     try:
-        Jack.start_watching()
-        Andrew.start_processing()
+        if Jack is not None:
+            Jack.start_watching()
+        if Andrew is not None:
+            Andrew.start_processing()
+        else:
+            while True:
+                time.sleep(1)
     except KeyboardInterrupt:
-        Jack.stop()
+        if Jack is not None:
+            Jack.stop()
         print("Interupted by keyboard.")
-
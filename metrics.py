@@ -0,0 +1,155 @@
+"""Counters and timings of the ingest, in the Prometheus text format."""
+
+import logging
+import logging.config
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('root')
+
+# The upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Metrics:
+
+    def __init__(self):
+        """Keep the counters, gauges and histograms by name and labels."""
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        """Set the help text of the metric."""
+        self._help[name] = text
+
+    def count(self, name, amount=1, **labels):
+        """Increase the counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set the gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Put the value in the histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            buckets = histogram[0]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    buckets[index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    @contextmanager
+    def time(self, stage):
+        """Time the stage of the process."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('dwarf_stage_seconds', time.perf_counter() - start,
+                         stage=stage)
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters),
+                                  ('gauge', self._gauges)):
+                for name in sorted(set(name for name, _ in metrics)):
+                    lines.extend(self._header(name, kind))
+                    for (key, labels), value in sorted(metrics.items()):
+                        if key == name:
+                            lines.append("{}{} {}".format(
+                                name, _labels(labels), value))
+
+            for name in sorted(set(name for name, _ in self._histograms)):
+                lines.extend(self._header(name, 'histogram'))
+                for (key, labels), (buckets, num, total) in sorted(
+                        self._histograms.items()):
+                    if key != name:
+                        continue
+                    for bound, value in zip(BUCKETS, buckets):
+                        lines.append("{}_bucket{} {}".format(
+                            name, _labels(labels + (('le', bound),)), value))
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(labels + (('le', '+Inf'),)), num))
+                    lines.append("{}_count{} {}".format(name, _labels(labels), num))
+                    lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, kind):
+        """Return the HELP and TYPE lines of the metric."""
+        header = ["# TYPE {} {}".format(name, kind)]
+        if name in self._help:
+            header.insert(0, "# HELP {} {}".format(name, self._help[name]))
+        return header
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serve the metrics at http://address:port/metrics in a thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info("[*] Metrics served at http://{}:{}/metrics".format(
+            address, port))
+
+    def dump_periodically(self, interval):
+        """Write the metrics into the log every `interval` seconds."""
+        def dump():
+            while True:
+                time.sleep(interval)
+                logger.info("Metrics:\n{}".format(self.render()))
+
+        threading.Thread(target=dump, daemon=True).start()
+
+
+def _labels(labels):
+    """Format the labels, like `{stage="probe"}`."""
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+# All the workers share the same metrics.
+METRICS = Metrics()
+METRICS.describe('dwarf_stage_seconds', "Time spent in each stage of the process.")
+METRICS.describe('dwarf_files_total', "Files processed, by outcome.")
+METRICS.describe('dwarf_bytes_total', "Bytes of the files stocked.")
+METRICS.describe('dwarf_placements_total', "Files placed in the dock, by strategy.")
+METRICS.describe('dwarf_paintings_total', "Files painted, by outcome.")
+METRICS.describe('dwarf_queue_depth', "Messages waiting in the queue.")
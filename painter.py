@@ -0,0 +1,154 @@
+"""The painter draws thumbnails of the stocked files and hashes their looks.
+
+The perceptual hashes are 64 bits each, written as 16 hex digits. Files that
+look alike have hashes of a small Hamming distance, even if they are resized
+or encoded again.
+"""
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+from PIL import Image
+
+# The 32-point DCT basis of the 8 lowest frequencies, used by pHash.
+DCT_SIZE = 32
+DCT_KEEP = 8
+COSINES = [[math.cos(math.pi * u * (2 * x + 1) / (2 * DCT_SIZE))
+            for x in range(DCT_SIZE)] for u in range(DCT_KEEP)]
+
+
+def _bits_to_hex(bits):
+    """Pack 64 booleans into 16 hex digits."""
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return "{:016x}".format(value)
+
+
+def dhash(image):
+    """Return the difference hash of the image.
+
+    Every bit tells if a pixel is brighter than its right neighbour, in a 9x8
+    grayscale copy of the image.
+    """
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    return _bits_to_hex(pixels[row * 9 + col] > pixels[row * 9 + col + 1]
+                        for row in range(8) for col in range(8))
+
+
+def phash(image):
+    """Return the perceptual hash of the image.
+
+    Every bit tells if one of the 8x8 lowest DCT frequencies of a 32x32
+    grayscale copy of the image is above their median.
+    """
+    pixels = list(image.convert('L').resize((DCT_SIZE, DCT_SIZE),
+                                            Image.BILINEAR).getdata())
+    rows = [pixels[y * DCT_SIZE:(y + 1) * DCT_SIZE] for y in range(DCT_SIZE)]
+
+    # The 2D DCT is separable: transform the rows first, then the columns.
+    row_freqs = [[sum(p * c for p, c in zip(row, COSINES[u]))
+                  for u in range(DCT_KEEP)] for row in rows]
+    freqs = [sum(row_freqs[y][u] * COSINES[v][y] for y in range(DCT_SIZE))
+             for v in range(DCT_KEEP) for u in range(DCT_KEEP)]
+
+    # The DC term is far from the others and is left out of the median.
+    median = sorted(freqs[1:])[len(freqs[1:]) // 2]
+    return _bits_to_hex(freq > median for freq in freqs)
+
+
+def paint_image(image_file, album, name, size):
+    """Draw a thumbnail of the image and hash it.
+
+    Args:
+        image_file: the image to be painted.
+        album: the directory of the thumbnails.
+        name: the base name of the thumbnail.
+        size: the longest side of the thumbnail in pixels.
+
+    Returns:
+        a dict of the thumbnail paths and the perceptual hashes.
+    """
+    thumbnail = os.path.join(album, name + ".jpg")
+    with Image.open(image_file) as image:
+        # JPEG images could be decoded at a lower scale right away.
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+        image.thumbnail((size, size))
+        image.save(thumbnail, 'JPEG', quality=85)
+
+    return {"thumbnails": [thumbnail],
+            "phash": phash(image),
+            "dhash": dhash(image)}
+
+
+def paint_video(video_file, album, name, size, num_frames, duration):
+    """Draw thumbnails of a few keyframes of the video and hash the middle one.
+
+    Only the keyframes are decoded. The frames are taken at even intervals,
+    each from the keyframe nearest to it.
+
+    Args:
+        video_file: the video to be painted.
+        album: the directory of the thumbnails.
+        name: the base name of the thumbnails.
+        size: the longest side of the thumbnails in pixels.
+        num_frames: how many frames to draw.
+        duration: the length of the video in seconds.
+
+    Returns:
+        a dict of the thumbnail paths and the perceptual hashes.
+    """
+    if not duration:
+        num_frames = 1
+
+    thumbnails = []
+    for index in range(num_frames):
+        thumbnail = os.path.join(album, "{}_{}.jpg".format(name, index))
+        (ffmpeg.input(video_file, ss=duration * (index + 1) / (num_frames + 1),
+                      skip_frame='nokey', noaccurate_seek=None)
+         .filter('scale', size, size, force_original_aspect_ratio='decrease')
+         .output(thumbnail, vframes=1)
+         .overwrite_output()
+         .run(quiet=True))
+        thumbnails.append(thumbnail)
+
+    with Image.open(thumbnails[len(thumbnails) // 2]) as image:
+        return {"thumbnails": thumbnails,
+                "phash": phash(image),
+                "dhash": dhash(image)}
+
+
+class Painter:
+
+    def __init__(self, num_processes=2, size=256, num_frames=3):
+        """A painter draws in processes of its own, away from the ingest.
+
+        The processes are spawned rather than forked, as the daemon holds
+        threads and sockets that should not be copied.
+
+        Args:
+            num_processes: how many files to paint at the same time.
+            size: the longest side of the thumbnails in pixels.
+            num_frames: how many keyframes to draw for every video.
+        """
+        self.size = size
+        self.num_frames = num_frames
+        self._pool = ProcessPoolExecutor(
+            max_workers=num_processes,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def paint(self, file_path, album, name, is_video=False, duration=0):
+        """Paint the file in the background.
+
+        Returns:
+            a future of the dict of the thumbnail paths and the hashes.
+        """
+        if is_video:
+            return self._pool.submit(paint_video, file_path, album, name,
+                                     self.size, self.num_frames, duration)
+        return self._pool.submit(paint_image, file_path, album, name,
+                                 self.size)
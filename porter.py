@@ -1,15 +1,19 @@
 """The watchdog watches the barn for any file changes."""
 
+import fnmatch
 import logging
 import logging.config
 import os
 import sys
+import threading
+import time
 
 import yaml
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
-from rabbit import Rabbit
+from rabbit import speaker
+from scout import Scout
 
 # Setup the logger.
 logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
@@ -23,28 +27,100 @@ with open(CFG_FILE, 'r') as f:
 
 class FolderEventHandler(FileSystemEventHandler):
 
-    def __init__(self, messenger):
+    def __init__(self, messenger, quiet_window, ignore):
+        """Collect the file events and report the files once they are stable.
+
+        A single file may raise several events while it is being copied or
+        edited. The events are coalesced in a pending table keyed by path, and
+        a file is reported only after it has been quiet for a while.
+
+        Args:
+            messenger: a rabbit to deliver the messages.
+            quiet_window: how many seconds a file should stay quiet.
+            ignore: filename patterns of the temporary files to be ignored.
+        """
         super().__init__()
 
         # Summon a rabbit.
         self.messenger = messenger
 
+        self.quiet_window = quiet_window
+        self.ignore = ignore
+        self._pending = {}
+        self._lock = threading.Lock()
+
     def on_created(self, event):
         logger.debug("{}:{}".format(event.event_type, event.src_path))
 
     def on_modified(self, event):
         logger.debug("{}:{}".format(event.event_type, event.src_path))
+        self.refresh(event.src_path)
 
     def on_deleted(self, event):
         logger.debug("{}:{}".format(event.event_type, event.src_path))
+        self.forget(event.src_path)
 
     def on_closed(self, event):
         logger.debug("{}:{}".format(event.event_type, event.src_path))
-        self.send_message(event.src_path)
+        self.touch(event.src_path)
+
+    def on_moved(self, event):
+        logger.debug("{}:{} -> {}".format(event.event_type,
+                                          event.src_path, event.dest_path))
+        self.forget(event.src_path)
+
+        # The files in a directory moved in raise no events of their own.
+        if event.is_directory:
+            for path, _, _ in Scout().explore(event.dest_path):
+                self.touch(path)
+        else:
+            self.touch(event.dest_path)
+
+    def is_ignored(self, src_path):
+        """Tell if the file is a temporary one, like rsync's `.name.XXXXXX`."""
+        name = os.path.basename(src_path)
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def touch(self, src_path):
+        """Put the file in the pending table, or reset its quiet time."""
+        if self.is_ignored(src_path):
+            return
+        with self._lock:
+            self._pending[src_path] = time.monotonic()
+
+    def refresh(self, src_path):
+        """Reset the quiet time if the file is pending."""
+        with self._lock:
+            if src_path in self._pending:
+                self._pending[src_path] = time.monotonic()
+
+    def forget(self, src_path):
+        """Remove the file from the pending table."""
+        with self._lock:
+            self._pending.pop(src_path, None)
+
+    def send_messages(self, everything=False):
+        """Report the files that have been quiet long enough.
 
-    def send_message(self, src_path):
-        if not os.path.isdir(src_path):
-            self.messenger.speak(src_path)
+        Args:
+            everything: report all the pending files no matter how long they
+                have been quiet.
+        """
+        deadline = time.monotonic() - self.quiet_window
+        with self._lock:
+            stable = {path: last_seen for path, last_seen in self._pending.items()
+                      if everything or last_seen <= deadline}
+            for path in stable:
+                del self._pending[path]
+
+        files = [path for path in stable if os.path.isfile(path)]
+        if files and not self.messenger.speak_many(files):
+            # Keep them pending to be reported next time, unless they were
+            # touched again in the meantime.
+            logger.error("Failed to report {} files.".format(len(files)))
+            with self._lock:
+                for path in files:
+                    self._pending.setdefault(path, stable[path])
 
 
 class Porter:
@@ -58,22 +134,34 @@ class Porter:
         # Where is the barn to watch? Make sure the folder already existed.
         assert os.path.exists(target), "Target folder not found, please check."
 
-        self._rabbit = Rabbit(address=CFG['rabbitmq']['host'],
-                              port=CFG['rabbitmq']['port'],
-                              queue=CFG['rabbitmq']['queue'],
-                              talking=True)
+        self._rabbit = speaker()
 
         # Setup the file observer.
         self.observer = Observer()
-        self.event_handler = FolderEventHandler(self._rabbit)
+        self.event_handler = FolderEventHandler(self._rabbit,
+                                                CFG['porter']['quiet_window'],
+                                                CFG['porter']['ignore'])
         self.observer.schedule(self.event_handler, target, recursive=True)
 
+        # The stable files are reported by another thread.
+        self._stopped = threading.Event()
+        self._reporter = threading.Thread(target=self.report, daemon=True)
+
     def start_watching(self):
         """Staring to watch the changes."""
         self.observer.start()
+        self._reporter.start()
         logger.info('[*] Monitoring...')
 
+    def report(self):
+        """Report the stable files periodically."""
+        while not self._stopped.wait(self.event_handler.quiet_window / 2):
+            self.event_handler.send_messages()
+
     def stop(self):
         """Let it go."""
         self.observer.stop()
         self.observer.join()
+        self._stopped.set()
+        self._reporter.join()
+        self.event_handler.send_messages(everything=True)
@@ -1,6 +1,12 @@
 """This module provides the implementation of the message queue."""
+import itertools
 import logging
 import logging.config
+import sys
+import threading
+import time
+import zlib
+from queue import Empty, Queue
 
 import pika
 import yaml
@@ -9,10 +15,44 @@ import yaml
 logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
 logger = logging.getLogger('rabbit')
 
+# Load the configuration file.
+CFG_FILE = sys.argv[1] if len(sys.argv) > 1 else 'config.yml'
+with open(CFG_FILE, 'r') as f:
+    CFG = yaml.load(f, Loader=yaml.FullLoader)
+
+# The shortest and longest waits before standing up again, in seconds. The
+# wait is doubled after every failure.
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30
+
+# How many times a batch is sent before giving up.
+MAX_TRIES = 5
+
+# The longest time in seconds a speaker waits for its batch to be sent.
+SPEAK_TIMEOUT = 300
+
+
+def shard_of(message, num_shards):
+    """Return the shard of the message. The same file always goes to the
+    same shard."""
+    if isinstance(message, str):
+        message = message.encode()
+    return zlib.crc32(message) % num_shards
+
+
+class Parcel:
+
+    def __init__(self, messages):
+        """A batch of messages waiting to be sent by the talking rabbit."""
+        self.messages = messages
+        self.succeed = False
+        self.sent = threading.Event()
+
 
 class Rabbit:
 
-    def __init__(self, address, port, queue, talking=False, callback=None):
+    def __init__(self, address, port, queue, talking=False, callback=None,
+                 retry_delay=None, num_shards=1, shards=None, heartbeat=60):
         """Summon a rabbit to deliver messages.
 
         Args:
@@ -21,20 +61,40 @@ class Rabbit:
             queue: the queue name.
             talking: on which mode the rabbit will be, talking or listening?
             callback: the callback function if the rabbit will listen.
+            retry_delay: seconds a postponed message waits in the retry queue
+                before it comes back. No retry queue if not provided.
+            num_shards: the messages are spread over this many queues, named
+                like `queue.0`, `queue.1`... by the file path.
+            shards: which of the shards to listen to, all if not provided.
+            heartbeat: seconds between the heartbeats, so that a dead
+                connection is found and an idle one is kept alive.
         """
-        self._recipe = pika.ConnectionParameters(address, port)
+        self._recipe = pika.ConnectionParameters(
+            address, port, heartbeat=heartbeat,
+            blocked_connection_timeout=heartbeat)
         self._connection = None
         self._channel = None
         self._queue = queue
+        self._retry_delay = retry_delay
+        self._num_shards = num_shards
+        self._shards = list(range(num_shards)) if shards is None else list(shards)
         self._talking = talking
         self._callback = callback
+        self._tasks = []
 
         # Safety check.
         if not self._talking:
             assert self._callback is not None, "A callback function is required for a listening rabbit."
-        
-        # Ready the rabbit.
-        self.stand_up()
+
+        # A talking rabbit owns its connection in a thread of its own. The
+        # batches of all the speakers are queued and sent by that thread.
+        if self._talking:
+            self._outbox = Queue()
+            threading.Thread(target=self._speak_forever,
+                             name='rabbit-speaker',
+                             daemon=True).start()
+        else:
+            self.stand_up_patiently()
 
     def stand_up(self):
         """The rabbit has to stand up before it speaks."""
@@ -42,38 +102,264 @@ class Rabbit:
 
         self._connection = pika.BlockingConnection(self._recipe)
         self._channel = self._connection.channel()
-        self._channel.queue_declare(queue=self._queue, durable=True)
+        for shard in range(self._num_shards):
+            queue = self.queue_name(shard)
+            self._channel.queue_declare(queue=queue, durable=True)
 
-    def speak(self, message):
-        """Send a mesage. This process may fail if the other rabbits had waited
-        for a long time. So at least try twice.
+            # Nobody consumes the retry queue. The messages expire in it and
+            # then are dead-lettered back to the main queue.
+            if self._retry_delay is not None:
+                self._channel.queue_declare(
+                    queue=queue + ".retry",
+                    durable=True,
+                    arguments={'x-message-ttl': int(self._retry_delay * 1000),
+                               'x-dead-letter-exchange': '',
+                               'x-dead-letter-routing-key': queue})
+
+        # A talking rabbit publishes in transactions. Messages of a batch are
+        # pipelined, and the commit returns only after the server has taken
+        # all of them.
+        if self._talking:
+            self._channel.tx_select()
+
+        # The periodic tasks belong to the connection. Set them up again.
+        for seconds, func in self._tasks:
+            self._call_later(seconds, func)
+
+    def stand_up_patiently(self, max_tries=None):
+        """Stand up, and wait longer after every failure.
+
+        Args:
+            max_tries: how many times to try, or forever if not provided.
+
+        Returns:
+            succeed: True if the rabbit stands up.
         """
-        for _ in ["once", "twice"]:
+        delay = BACKOFF_MIN
+        for num_tries in itertools.count(1):
             try:
-                self._channel.basic_publish(
-                    exchange='',
-                    routing_key=self._queue,
-                    body=message,
-                    properties=pika.BasicProperties(delivery_mode=2))
-                succeed = True
-            except pika.exceptions.StreamLostError:
-                logger.error("The rabbit can not speak, trying again...")
                 self.stand_up()
+                return True
+            except pika.exceptions.AMQPError:
+                self._sit_down()
+                if max_tries is not None and num_tries >= max_tries:
+                    break
+                logger.error("The rabbit can not stand up, trying again in "
+                             "{:.1f}s...".format(delay))
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+
+        return False
+
+    def queue_name(self, shard):
+        """Return the queue name of the shard."""
+        if self._num_shards == 1:
+            return self._queue
+        return "{}.{}".format(self._queue, shard)
+
+    def route(self, message):
+        """Return the queue the message should go to."""
+        return self.queue_name(shard_of(message, self._num_shards))
+
+    def speak(self, message):
+        """Send a mesage and wait until the server confirms it."""
+        return self.speak_many([message])
+
+    def speak_many(self, messages):
+        """Send a batch of messages and wait until the server confirms them.
+
+        Any thread could speak. The batch is handed over to the thread owning
+        the connection, and sent together with the batches of other speakers.
+
+        Args:
+            messages: a list of messages to send.
+
+        Returns:
+            succeed: True if the server has taken all the messages.
+        """
+        if not messages:
+            return True
+
+        parcel = Parcel(messages)
+        self._outbox.put(parcel)
+        if not parcel.sent.wait(SPEAK_TIMEOUT):
+            logger.error("The rabbit did not send {} messages in time.".format(
+                len(messages)))
+            return False
+        return parcel.succeed
+
+    def _speak_forever(self):
+        """Send the queued batches, and keep the connection alive in between."""
+        while True:
+            try:
+                parcels = [self._outbox.get(timeout=1)]
+            except Empty:
+                self._keep_alive()
+                continue
+
+            # All the batches waiting are sent in the same transaction.
+            while True:
+                try:
+                    parcels.append(self._outbox.get_nowait())
+                except Empty:
+                    break
+
+            # Whatever goes wrong, the speakers must not wait forever.
+            try:
+                succeed = self._publish([message for parcel in parcels
+                                         for message in parcel.messages])
+            except Exception:
+                logger.exception("The rabbit failed to speak.")
+                self._sit_down()
                 succeed = False
-            finally:
-                if succeed:
+            for parcel in parcels:
+                parcel.succeed = succeed
+                parcel.sent.set()
+
+    def _publish(self, messages):
+        """Publish the messages in a transaction, on the speaker thread.
+
+        If the connection is lost in the middle, the server discards the
+        uncommitted messages and the whole batch is sent again after a while,
+        so nothing is dropped.
+        """
+        delay = BACKOFF_MIN
+        for num_tries in range(1, MAX_TRIES + 1):
+            try:
+                if self._connection is None or self._connection.is_closed:
+                    self.stand_up()
+                for message in messages:
+                    self._channel.basic_publish(
+                        exchange='',
+                        routing_key=self.route(message),
+                        body=message,
+                        properties=pika.BasicProperties(delivery_mode=2))
+                self._channel.tx_commit()
+                return True
+            except pika.exceptions.AMQPError:
+                self._sit_down()
+                if num_tries == MAX_TRIES:
                     break
+                logger.error("The rabbit can not speak, trying again in "
+                             "{:.1f}s...".format(delay))
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
 
-        return succeed
+        logger.error("The rabbit failed to send {} messages.".format(len(messages)))
+        return False
 
-    def start_listening(self):
-        """Listen to the comming messages."""
-        self._channel.basic_qos(prefetch_count=1)
-        self._channel.basic_consume(queue=self._queue,
-                                    on_message_callback=self._callback,
-                                    auto_ack=False)
-        self._channel.start_consuming()
+    def _keep_alive(self):
+        """Send and receive the heartbeats of an idle connection."""
+        if self._connection is None or self._connection.is_closed:
+            return
+        try:
+            self._connection.process_data_events(time_limit=0)
+        except Exception:
+            logger.debug("The idle connection is lost.")
+            self._sit_down()
+
+    def _sit_down(self):
+        """Close the connection quietly, so that its socket is not leaked."""
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+    def postpone(self, message, attempts):
+        """Send the message back to the queue after the retry delay.
+
+        Args:
+            message: the message to be postponed.
+            attempts: how many times the message has been tried.
+        """
+        self._channel.basic_publish(
+            exchange='',
+            routing_key=self.route(message) + ".retry",
+            body=message,
+            properties=pika.BasicProperties(delivery_mode=2,
+                                            headers={'x-attempts': attempts}))
+
+    def queue_depth(self):
+        """Return how many messages are waiting in the queues listened to."""
+        return sum(self._channel.queue_declare(
+            queue=self.queue_name(shard), durable=True,
+            passive=True).method.message_count for shard in self._shards)
+
+    def every(self, seconds, func):
+        """Call the function on the connection thread every a few seconds.
+
+        The task is kept after the rabbit stands up again.
+        """
+        self._tasks.append((seconds, func))
+        self._call_later(seconds, func)
+
+    def _call_later(self, seconds, func):
+        """Call the function on the current connection every a few seconds."""
+        connection = self._connection
+
+        def call():
+            try:
+                func()
+            except pika.exceptions.AMQPError:
+                logger.debug("Failed to run the periodic task.")
+            if connection.is_open:
+                connection.call_later(seconds, call)
+
+        connection.call_later(seconds, call)
+
+    def start_listening(self, prefetch_count=1):
+        """Listen to the comming messages.
+
+        Args:
+            prefetch_count: how many unacknowledged messages could be delivered
+                at the same time.
+        """
+        while True:
+            try:
+                # The limit is shared by the consumers of all the shards.
+                self._channel.basic_qos(prefetch_count=prefetch_count,
+                                        global_qos=True)
+                for shard in self._shards:
+                    self._channel.basic_consume(
+                        queue=self.queue_name(shard),
+                        on_message_callback=self._callback,
+                        auto_ack=False)
+                self._channel.start_consuming()
+                return
+            except pika.exceptions.AMQPError:
+                # The messages not acknowledged yet will be delivered again.
+                logger.error("The rabbit lost the connection, standing up again...")
+                self._sit_down()
+                self.stand_up_patiently()
 
     def rest(self):
         """Let the rabbit rest."""
-        self._connection.close()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+
+# Everyone talking in the same process shares the same rabbit.
+_speaker = None
+_speaker_lock = threading.Lock()
+
+
+def speaker():
+    """Return the talking rabbit shared in this process.
+
+    It is summoned only when there is something to say, so the maintenance
+    commands could run without the message queue.
+    """
+    global _speaker
+    with _speaker_lock:
+        if _speaker is None:
+            _speaker = Rabbit(address=CFG['rabbitmq']['host'],
+                              port=CFG['rabbitmq']['port'],
+                              queue=CFG['rabbitmq']['queue'],
+                              talking=True,
+                              num_shards=CFG['rabbitmq']['shards'],
+                              heartbeat=CFG['rabbitmq']['heartbeat'])
+        return _speaker
@@ -0,0 +1,177 @@
+"""A scout walks through a directory tree and reports the files found."""
+
+import logging
+import logging.config
+import os
+import queue
+import sqlite3
+import threading
+
+import yaml
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('scout')
+
+# Marks the end of the walk in the report queue.
+_DONE = object()
+
+
+class Scout:
+
+    def __init__(self, num_walkers=4, max_pending=1024):
+        """A scout sends walkers down the subdirectories at the same time.
+
+        Args:
+            num_walkers: how many directories could be listed in parallel.
+            max_pending: how many files could wait in the report queue. The
+                walkers pause once the queue is full, so the memory is bounded.
+        """
+        self.num_walkers = num_walkers
+        self.max_pending = max_pending
+
+    def explore(self, top):
+        """Walk through the directory and yield the files as they are found.
+
+        Args:
+            top: the directory to be explored.
+
+        Yields:
+            (path, size, mtime) of every regular file under the directory.
+        """
+        dirs = queue.Queue()
+        reports = queue.Queue(maxsize=self.max_pending)
+        stopped = threading.Event()
+        dirs.put(top)
+
+        # The reader may leave before the walk is done. Nothing waits on a
+        # full queue after that.
+        def deliver(report):
+            while not stopped.is_set():
+                try:
+                    reports.put(report, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        # Every walker lists one directory at a time. Subdirectories are put
+        # back into the queue for any walker to pick up.
+        def walk():
+            while True:
+                current = dirs.get()
+                if current is _DONE:
+                    dirs.task_done()
+                    break
+                try:
+                    if stopped.is_set():
+                        continue
+                    with os.scandir(current) as entries:
+                        for entry in entries:
+                            if stopped.is_set():
+                                break
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    dirs.put(entry.path)
+                                elif entry.is_file(follow_symlinks=False):
+                                    stat = entry.stat(follow_symlinks=False)
+                                    deliver((entry.path,
+                                             stat.st_size,
+                                             stat.st_mtime_ns))
+                            except OSError:
+                                logger.debug(
+                                    "{}: Failed to check entry.".format(entry.path))
+                except OSError:
+                    logger.debug(
+                        "{}: Failed to list directory.".format(current))
+                finally:
+                    dirs.task_done()
+
+        walkers = [threading.Thread(target=walk, daemon=True)
+                   for _ in range(self.num_walkers)]
+        for walker in walkers:
+            walker.start()
+
+        # Once every directory is listed, let the walkers and the reader go.
+        def supervise():
+            dirs.join()
+            if stopped.is_set():
+                return
+            for _ in walkers:
+                dirs.put(_DONE)
+            deliver(_DONE)
+
+        threading.Thread(target=supervise, daemon=True).start()
+
+        try:
+            while True:
+                report = reports.get()
+                if report is _DONE:
+                    break
+                yield report
+        finally:
+            # The reader may leave early. Call the walkers back, they skip
+            # the directories left in the queue.
+            stopped.set()
+            for _ in walkers:
+                dirs.put(_DONE)
+
+
+class Logbook:
+
+    def __init__(self, db_file):
+        """A logbook remembers the files already reported.
+
+        The entries are kept in a SQLite file instead of the memory, so a barn
+        with millions of files costs nothing but disk space.
+
+        Args:
+            db_file: the SQLite file to keep the entries.
+        """
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+
+        # Commits are frequent, let them cost no sync of their own.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)")
+        self._lock = threading.Lock()
+        self._num_uncommitted = 0
+
+    def is_new(self, path, size, mtime):
+        """Return True if the file was not reported, or changed since then."""
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime FROM files WHERE path=?",
+                                   (path,)).fetchone()
+        return row != (size, mtime)
+
+    def write_down(self, path, size, mtime):
+        """Remember the file. It is committed with the others later, call
+        `commit` once a batch is written down."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                             (path, size, mtime))
+            self._commit_lazily()
+
+    def strike_out(self, path):
+        """Forget the file, so it will be reported again next time."""
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path=?", (path,))
+            self._db.commit()
+            self._num_uncommitted = 0
+
+    def _commit_lazily(self):
+        """Commit the changes once in a while instead of one by one."""
+        self._num_uncommitted += 1
+        if self._num_uncommitted >= 1000:
+            self._db.commit()
+            self._num_uncommitted = 0
+
+    def commit(self):
+        """Save all the entries."""
+        with self._lock:
+            self._db.commit()
+            self._num_uncommitted = 0
+
+    def close(self):
+        """Save all the entries before leaving."""
+        self.commit()
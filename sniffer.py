@@ -0,0 +1,312 @@
+"""Read the tags of the common media files from their headers only.
+
+Opening an image with PIL or forking ffprobe for a video costs far more than
+the tags we need. The sniffers here read a few KB from the file header and
+return the same tags, or None if the file is unusual, in which case the
+caller should fall back to the full parser.
+"""
+
+import os
+import struct
+
+# Only this many bytes are read from the file header.
+HEAD_SIZE = 64 * 1024
+
+# The largest `moov` atom to be parsed. Larger ones are left to ffprobe.
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+
+# Codec names of the MP4 sample entries, as ffprobe reports them.
+MP4_CODECS = {b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc',
+              b'hev1': 'hevc', b'mp4v': 'mpeg4', b'av01': 'av1',
+              b'vp09': 'vp9', b'mp4a': 'aac', b'ac-3': 'ac3',
+              b'ec-3': 'eac3', b'Opus': 'opus', b'.mp3': 'mp3'}
+MP4_HANDLERS = {b'vide': 'video', b'soun': 'audio'}
+
+# Codec names of the AVI streams, as ffprobe reports them.
+AVI_VIDEO_CODECS = {b'H264': 'h264', b'X264': 'h264', b'AVC1': 'h264',
+                    b'XVID': 'mpeg4', b'DIVX': 'mpeg4', b'DX50': 'mpeg4',
+                    b'FMP4': 'mpeg4', b'MJPG': 'mjpeg', b'HEVC': 'hevc'}
+AVI_AUDIO_CODECS = {0x0001: 'pcm_s16le', 0x0055: 'mp3', 0x00FF: 'aac',
+                    0x2000: 'ac3'}
+
+
+def sniff_image(image_file):
+    """Return the basic tags of a JPEG, PNG, GIF or BMP file, or None."""
+    with open(image_file, 'rb') as f:
+        head = f.read(32)
+
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR' \
+                and len(head) >= 24:
+            width, height = struct.unpack('>II', head[16:24])
+            return _image_tags('PNG', width, height)
+
+        if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+            width, height = struct.unpack('<HH', head[6:10])
+            return _image_tags('GIF', width, height)
+
+        if head.startswith(b'BM') and len(head) >= 26:
+            dib_size = struct.unpack('<I', head[14:18])[0]
+            if dib_size == 12:
+                width, height = struct.unpack('<HH', head[18:22])
+            else:
+                width, height = struct.unpack('<ii', head[18:26])
+            return _image_tags('BMP', width, abs(height))
+
+        if head.startswith(b'\xff\xd8'):
+            return _sniff_jpeg(f)
+
+    return None
+
+
+def _image_tags(image_format, width, height):
+    """Return the image tags in the same form as `get_image_tags`."""
+    return {"format": image_format,
+            "width:": width,
+            "height": height}
+
+
+def _sniff_jpeg(f):
+    """Find the SOF segment by skipping over the other segments."""
+    f.seek(2)
+    while f.tell() < HEAD_SIZE:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+
+        # Fill bytes may come before the marker.
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        code = marker[1]
+
+        # Markers without any payload.
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+
+        # SOF0 to SOF15, except DHT, JPG and DAC which share the range.
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            payload = f.read(5)
+            if len(payload) < 5:
+                return None
+            height, width = struct.unpack('>HH', payload[1:5])
+            return _image_tags('JPEG', width, height)
+
+        if code in (0xD9, 0xDA):
+            return None
+        f.seek(length - 2, os.SEEK_CUR)
+
+    return None
+
+
+def sniff_video(video_path):
+    """Return the format and stream tags of an MP4 or AVI file, or None.
+
+    The tags are a subset of the ffprobe output.
+    """
+    with open(video_path, 'rb') as f:
+        head = f.read(12)
+        size = os.fstat(f.fileno()).st_size
+
+        if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+            f.seek(0)
+            tags = _sniff_avi(f.read(HEAD_SIZE))
+        elif head[4:8] == b'ftyp':
+            tags = _sniff_mp4(f, size)
+        else:
+            tags = None
+
+    if tags is not None:
+        tags['format']['size'] = str(size)
+    return tags
+
+
+def _boxes(data, offset=0, end=None):
+    """Iterate over the MP4 boxes in the data, yields (type, start, end)."""
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def _find_box(data, path, offset=0, end=None):
+    """Find the first box along the path, returns (start, end) or None."""
+    for box_type, start, stop in _boxes(data, offset, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return start, stop
+            return _find_box(data, path[1:], start, stop)
+    return None
+
+
+def _read_moov(f, size):
+    """Walk the top level boxes and read the `moov` box wherever it is."""
+    offset = 0
+    while offset + 8 <= size:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return None
+        box_size, box_type = struct.unpack('>I4s', header[:8])
+        if box_size == 1:
+            box_size = struct.unpack('>Q', header[8:16])[0]
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            return None
+        if box_type == b'moov':
+            if box_size > MAX_MOOV_SIZE:
+                return None
+            f.seek(offset)
+            return f.read(box_size)
+        offset += box_size
+    return None
+
+
+def _duration(data, start):
+    """Parse the timescale and duration of a `mvhd` or `mdhd` box."""
+    if data[start] == 1:
+        timescale, duration = struct.unpack('>IQ', data[start + 20:start + 32])
+    else:
+        timescale, duration = struct.unpack('>II', data[start + 12:start + 20])
+    return duration / timescale if timescale else 0
+
+
+def _sniff_mp4(f, size):
+    """Parse the movie header and the track headers."""
+    moov = _read_moov(f, size)
+    if moov is None:
+        return None
+
+    try:
+        mvhd = _find_box(moov, [b'moov', b'mvhd'])
+        if mvhd is None:
+            return None
+        duration = _duration(moov, mvhd[0])
+
+        streams = []
+        moov_start, moov_end = _find_box(moov, [b'moov'])
+        for box_type, start, end in _boxes(moov, moov_start, moov_end):
+            if box_type != b'trak':
+                continue
+            hdlr = _find_box(moov, [b'mdia', b'hdlr'], start, end)
+            mdhd = _find_box(moov, [b'mdia', b'mdhd'], start, end)
+            stsd = _find_box(moov, [b'mdia', b'minf', b'stbl', b'stsd'],
+                             start, end)
+            if hdlr is None or mdhd is None or stsd is None:
+                return None
+
+            handler = moov[hdlr[0] + 8:hdlr[0] + 12]
+            entry = stsd[0] + 8
+            codec_tag = moov[entry + 4:entry + 8]
+            if handler not in MP4_HANDLERS or codec_tag not in MP4_CODECS:
+                return None
+
+            stream = {"index": len(streams),
+                      "codec_name": MP4_CODECS[codec_tag],
+                      "codec_type": MP4_HANDLERS[handler],
+                      "codec_tag_string": codec_tag.decode('latin-1'),
+                      "duration": "{:.6f}".format(_duration(moov, mdhd[0]))}
+            if handler == b'vide':
+                width, height = struct.unpack('>HH',
+                                              moov[entry + 32:entry + 36])
+                stream.update({"width": width, "height": height})
+            streams.append(stream)
+    except (struct.error, IndexError, TypeError):
+        return None
+
+    # Fragmented files keep the duration somewhere else.
+    if not streams or not duration:
+        return None
+
+    return {"streams": streams,
+            "format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+                       "nb_streams": len(streams),
+                       "duration": "{:.6f}".format(duration)}}
+
+
+def _chunks(data, offset, end):
+    """Iterate over the RIFF chunks in the data, yields (id, start, end)."""
+    while offset + 8 <= end:
+        chunk_id, size = struct.unpack('<4sI', data[offset:offset + 8])
+        start = offset + 8
+        if chunk_id == b'LIST':
+            chunk_id = data[start:start + 4]
+            start += 4
+        yield chunk_id, start, min(offset + 8 + size, end)
+        offset += 8 + size + (size & 1)
+
+
+def _sniff_avi(head):
+    """Parse the `hdrl` list of an AVI file."""
+    try:
+        hdrl = next((start, end) for chunk_id, start, end
+                    in _chunks(head, 12, len(head)) if chunk_id == b'hdrl')
+        streams = []
+        duration = 0
+        for chunk_id, start, end in _chunks(head, *hdrl):
+            if chunk_id == b'avih':
+                usec_per_frame, = struct.unpack('<I', head[start:start + 4])
+                total_frames, = struct.unpack('<I', head[start + 16:start + 20])
+                duration = usec_per_frame * total_frames / 1e6
+            if chunk_id != b'strl':
+                continue
+
+            strh = strf = None
+            for sub_id, sub_start, sub_end in _chunks(head, start, end):
+                if sub_id == b'strh':
+                    strh = sub_start
+                elif sub_id == b'strf':
+                    strf = sub_start
+            if strh is None or strf is None:
+                return None
+
+            stream_type = head[strh:strh + 4]
+            scale, rate, _, length = struct.unpack(
+                '<IIII', head[strh + 20:strh + 36])
+            stream = {"index": len(streams),
+                      "duration": "{:.6f}".format(
+                          length * scale / rate if rate else 0)}
+            if stream_type == b'vids':
+                width, height = struct.unpack('<ii', head[strf + 4:strf + 12])
+                compression = head[strf + 16:strf + 20]
+                codec = AVI_VIDEO_CODECS.get(compression.upper())
+                stream.update({"codec_type": "video",
+                               "codec_tag_string": compression.decode('latin-1'),
+                               "width": width,
+                               "height": abs(height)})
+            elif stream_type == b'auds':
+                format_tag, = struct.unpack('<H', head[strf:strf + 2])
+                codec = AVI_AUDIO_CODECS.get(format_tag)
+                stream["codec_type"] = "audio"
+            else:
+                return None
+
+            if codec is None:
+                return None
+            stream["codec_name"] = codec
+            streams.append(stream)
+    except (StopIteration, struct.error, UnicodeDecodeError):
+        return None
+
+    if not streams:
+        return None
+
+    return {"streams": streams,
+            "format": {"format_name": "avi",
+                       "nb_streams": len(streams),
+                       "duration": "{:.6f}".format(duration)}}
@@ -1,17 +1,28 @@
 """The steward watches the file list and dispatch the tasks."""
 
 import datetime
+import functools
 import logging
 import logging.config
 import os
+import socket
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import ffmpeg
+import pika
 import yaml
 from PIL import Image
 
+from journal import CLEANED, HASHED, RECORDED, STOCKED, Journal
+from metrics import METRICS
+from painter import Painter
 from rabbit import Rabbit
+from sniffer import sniff_image, sniff_video
+from stocker import GALLERY
+from tag_cache import ManualTagCache, TagCache
 
 # Setup the logger.
 logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
@@ -25,17 +36,57 @@ with open(CFG_FILE, 'r') as f:
 
 def get_video_tags(video_path):
     """Check the video codec and return it."""
+    # Most videos could be told from the headers without forking ffprobe.
+    tags = sniff_video(video_path)
+    if tags is not None:
+        return tags
+
     return ffmpeg.probe(video_path)
 
 
 def get_image_tags(image_file):
     """Return the basic tags for image file."""
+    tags = sniff_image(image_file)
+    if tags is not None:
+        return tags
+
     with Image.open(image_file) as f:
         return {"format": f.format,
                 "width:": f.width,
                 "height": f.height}
 
 
+def get_flat_tags(raw_tags):
+    """Pick the tags worth querying from the raw tags, each in its own type.
+
+    The raw tags of the videos are in the ffprobe output, and those of the
+    images are a flat dict.
+    """
+    if 'streams' in raw_tags:
+        video = next((stream for stream in raw_tags['streams']
+                      if stream.get('codec_type') == 'video'), {})
+        tags = {"format": raw_tags.get('format', {}).get('format_name'),
+                "codec": video.get('codec_name'),
+                "width": video.get('width'),
+                "height": video.get('height'),
+                "duration": raw_tags.get('format', {}).get('duration')}
+    else:
+        tags = {"format": raw_tags.get('format'),
+                "width": raw_tags.get('width:', raw_tags.get('width')),
+                "height": raw_tags.get('height')}
+
+    flat = {}
+    for key, cast in (("format", str), ("codec", str), ("width", int),
+                      ("height", int), ("duration", float)):
+        try:
+            if tags.get(key) is not None:
+                flat[key] = cast(tags[key])
+        except (TypeError, ValueError):
+            pass
+
+    return flat
+
+
 def get_file_type(file_path):
     """Get the file type by it's suffix."""
     return os.path.splitext(file_path)[-1].split('.')[-1]
@@ -43,16 +94,74 @@ def get_file_type(file_path):
 
 class Steward:
 
-    def __init__(self, stocker, clark):
+    def __init__(self, stocker, clark, journal_file=None, node=None):
         """Steward is in charge of the data processing project.
 
         Args:
             clark: a clark to manage the books.
             stocker: a stocker to fill the warehouse.
+            journal_file: the journal of the files in process,
+                `journal.<node>.log` in the warehouse by default. Every
+                process needs its own.
+            node: the name of this steward among those sharing the
+                warehouse, the host name by default.
         """
         self.stocker = stocker
         self.clark = clark
 
+        # Which shards of the queue to process, all of them if None. Files
+        # are leased before being processed, so that no other node takes the
+        # same file at the same time.
+        self.shards = None
+        self.node = node or socket.gethostname()
+        self.lease_ttl = CFG['steward']['lease_ttl']
+
+        # A copy or a hash could take longer than the lease. Keep renewing
+        # the leases of the files in process until they are released.
+        self._leases = set()
+        self._leases_lock = threading.Lock()
+        if self.lease_ttl:
+            threading.Thread(target=self._renew_leases, name='lease',
+                             daemon=True).start()
+
+        # Where the new files come from. The root tag files are looked up in
+        # the top level directories of it.
+        self.barn = CFG['dirs']['barn']
+
+        # Files are processed by a pool of workers. They share the same clerk
+        # and stocker, whose database client and buffers are reused across
+        # all the files.
+        self.num_workers = CFG['steward']['workers']
+        self._pool = ThreadPoolExecutor(max_workers=self.num_workers,
+                                        thread_name_prefix='steward')
+
+        # Files of the same content share the same tags. Keep them so that
+        # the same content is never probed twice.
+        self.tag_cache = TagCache(
+            os.path.join(CFG['dirs']['warehouse'],
+                         'tags.{}.db'.format(self.node)),
+            CFG['steward']['tag_cache_mb'] * 1024 * 1024)
+
+        # All the files in a directory share the same manual tags.
+        self.manual_tag_cache = ManualTagCache()
+
+        # Keep a journal of the files in process, so a crash in the middle
+        # could be recovered from.
+        self.journal = Journal(
+            journal_file or os.path.join(CFG['dirs']['warehouse'],
+                                         'journal.{}.log'.format(self.node)),
+            CFG['steward']['journal']['commit_interval'],
+            CFG['steward']['journal']['max_mb'] * 1024 * 1024)
+
+        # Thumbnails and perceptual hashes are optional, and drawn in other
+        # processes after the file is recorded.
+        if CFG['painter']['enabled']:
+            self.painter = Painter(CFG['painter']['processes'],
+                                   CFG['painter']['size'],
+                                   CFG['painter']['frames'])
+        else:
+            self.painter = None
+
     def precheck(self, file_path):
         """Check the src file and return the parse function and the collection name.
 
@@ -83,53 +192,48 @@ class Steward:
 
         return True, parse_func, collection_name
 
-    def get_raw_tags(self, src_file, parse_func, max_num_try, timeout):
+    def is_ready(self, src_file, settle):
+        """Tell if the file is ready to be processed without waiting for it.
+
+        A file is considered fully written once it has not been modified for a
+        while.
+
+        Args:
+            src_file: the file's full path.
+            settle: how many seconds the file should stay untouched.
+        """
+        try:
+            last_modified = os.stat(src_file).st_mtime
+        except OSError:
+            return False
+
+        return time.time() - last_modified >= settle
+
+    def get_raw_tags(self, src_file, parse_func):
         """Get the tags from the source file.
 
         Args:
             src_file: the file's full path.
             parse_func: which function to use when parsing the file.
-            max_num_try: max times trying if the parsing fails.
-            timeout: how long to wait for a valid parsing.
 
         returns:
             process_succeed: a boolean value indicating the process status
             raw_tags: the parsed results.
         """
-        num_try = 0
-        seconds_wait = 0
-        process_succeed = False
-        raw_tags = {}
-
-        while True:
-
-            if num_try >= max_num_try:
-                logger.debug("Can not open file. Tried 3 times.")
-                break
-
-            if seconds_wait >= timeout:
-                logger.debug("Open file timeout: {} seconds.".format(timeout))
-                break
+        try:
+            return True, parse_func(src_file)
+        except FileNotFoundError:
+            logger.error("FFMPEG not installed correctly.")
+        except:
+            logger.debug("{}: Failed to open file.".format(src_file))
 
-            if not os.path.exists(src_file):
-                seconds_wait += 1
-                time.sleep(1)
-                continue
+        return False, {}
 
-            try:
-                num_try += 1
-                raw_tags = parse_func(src_file)
-                process_succeed = True
-                break
-            except FileNotFoundError:
-                logger.error("FFMPEG not installed correctly.")
-            except:
-                logger.debug("Failed to open file. Try again...")
-                # Wait for a moment so that the file could be fully created.
-                time.sleep(3)
-                continue
-
-        return process_succeed, raw_tags
+    def get_root_dir(self, src_file):
+        """Return the root directory of the file in the barn."""
+        barn = self.barn.rstrip(os.path.sep)
+        root_dir = src_file[len(barn):].split(os.path.sep)[1]
+        return os.path.join(barn, root_dir)
 
     def get_tag_files(self, src_file):
         """Return the tag files of the current file.
@@ -147,10 +251,9 @@ class Steward:
         opt_author_file = os.path.join(current_dir, 'authors.txt')
 
         # Then get the root tag file and author file.
-        barn = CFG['dirs']['barn'].rstrip(os.path.sep)
-        root_dir = src_file[len(barn):].split(os.path.sep)[1]
-        root_tag_file = os.path.join(barn, root_dir, 'tags.txt')
-        root_author_file = os.path.join(barn, root_dir, 'authors.txt')
+        root_dir = self.get_root_dir(src_file)
+        root_tag_file = os.path.join(root_dir, 'tags.txt')
+        root_author_file = os.path.join(root_dir, 'authors.txt')
 
         # Only return the desired files.
         tag_file = opt_tag_file if os.path.exists(
@@ -169,143 +272,520 @@ class Steward:
         return True, tag_file, author_file
 
     def get_manual_tags(self, src_file):
-        """Get the manual tags from the tag file and author file."""
-        file_got, tag_file, author_file = self.get_tag_files(src_file)
+        """Get the manual tags and authors of the file.
 
-        if file_got:
+        The tag files are looked up and read once for every directory. They
+        are read again once the porter reports a change of them, or once the
+        cache entry expires.
+        """
+        current_dir = os.path.dirname(src_file)
+        result = self.manual_tag_cache.get(current_dir)
+        if result is None:
+            file_got, tag_file, author_file = self.get_tag_files(src_file)
+            if file_got:
+                result = self.read_manual_tags(tag_file, author_file)
+            else:
+                result = False, None, None
+            self.manual_tag_cache.put(current_dir, result)
+
+        return result
+
+    def read_manual_tags(self, tag_file, author_file):
+        """Read the manual tags from the tag file and author file."""
+        try:
             with open(tag_file, 'r') as f:
                 tags = f.readline().split(' ')
             with open(author_file, 'r') as f:
                 authors = f.readline().split(' ')
-            succeed = True
-        else:
-            tags = None
-            authors = None
-            succeed = False
+        except OSError:
+            logger.debug("{}: Failed to read the tag files.".format(tag_file))
+            return False, None, None
 
-        return succeed, tags, authors
+        return True, tags, authors
+
+    def is_tag_file(self, src_file):
+        """Tell if the file holds the manual tags or authors."""
+        return os.path.basename(src_file) in ('tags.txt', 'authors.txt')
 
     def is_secret_mission(self, src_file):
         """A secret mission."""
         _, tail = os.path.split(src_file)
         return True if tail == 'dwarf.run' else False
 
-    def process(self, src_file):
-        """Process the sample file.
+    def stages(self, src_file):
+        """Walk the sample file through the stages of the process.
 
         Tasks:
             - Check if the file is valid and of interest.
             - Get the raw tags of the file and stock it the warehouse.
             - Create a valid record to be stored in the database.
 
-        Args:
-            src_file: the file to be processed.
+        This is a generator shared by the blocking and the asynchronous
+        stewards. Every blocking call is yielded as (stage, func, *args), and
+        the result is sent back once the driver has run it. The stage is one
+        of `io`, `db`, `probe` and `file`. A `file` call takes one more
+        argument, the callback of `Clerk.file_a_record`, whose arguments are
+        sent back instead.
 
         Returns:
-            succeed: a flag indicating the process accomplished successfully.
-            record_id: the database record id.
+            (succeed, record_id, retry) of the file. `retry` is True if the
+            file is not ready yet and should be tried again later.
         """
         # Mark the initial state to False to save a lot lines of code.
-        failure = False, None
+        failure = False, None, False
 
         # In case there is a secret mission.
         if self.is_secret_mission(src_file):
-            self.stocker.destry(src_file)
-            self.stocker.check_inventory()
+            yield 'io', self.stocker.destry, src_file
+            yield 'io', self.stocker.check_inventory
             logger.info("=★= Secret Mission =★=")
+            METRICS.count('dwarf_files_total', outcome='mission')
+            return failure
+
+        # The tag files may be changed. Read them again next time.
+        if self.is_tag_file(src_file):
+            self.manual_tag_cache.forget(os.path.dirname(src_file))
+            logger.info("    Tag file updated.")
+            METRICS.count('dwarf_files_total', outcome='tag_file')
             return failure
 
         # The file may be of any format. Precheck it to get the correct parse
         # function and the DB collection name.
-        succeed, parse_func, collection_name = self.precheck(src_file)
+        with METRICS.time('precheck'):
+            succeed, parse_func, collection_name = self.precheck(src_file)
         if not succeed:
             logger.warning("    File format not supported.")
+            METRICS.count('dwarf_files_total', outcome='unsupported')
             return failure
 
-        # Make sure this file was not processed before.
-        succeed, hash_value = self.stocker.get_checksum(src_file)
+        # The file may still be written. Do not wait for it, try it later.
+        ready = yield 'io', self.is_ready, src_file, CFG['monitor']['settle']
+        if not ready:
+            logger.warning("    File not ready.")
+            METRICS.count('dwarf_files_total', outcome='not_ready')
+            return False, None, True
+
+        # Most files are unique. Look for the records of the same size and
+        # fingerprint first, which costs only a few blocks of reading.
+        with METRICS.time('fingerprint'):
+            succeed, file_size, fingerprint = yield (
+                'io', self.stocker.get_fingerprint, src_file)
         if not succeed:
-            logger.warning("    Falied to get the hash checksum.")
+            logger.warning("    Failed to get the fingerprint.")
+            METRICS.count('dwarf_files_total', outcome='io_failure')
             return failure
-        already_existed = self.clark.check_existence(
-            hash_value, collection_name)
+        with METRICS.time('existence'):
+            candidate_found = yield ('db', self.clark.check_fingerprint,
+                                     file_size, fingerprint, collection_name)
+
+        # A file of the same fingerprint is a real duplicate only if the full
+        # hash matches as well, unless the fingerprint is trusted. The hash is
+        # computed without copying the file, and kept for the dock.
+        digests = None
+        if candidate_found:
+            already_existed = True
+            if not CFG['stocker']['hash']['trust_fingerprint']:
+                with METRICS.time('checksum'):
+                    succeed, digests = yield ('io', self.stocker.get_checksum,
+                                              src_file)
+                already_existed = False
+                if succeed:
+                    already_existed = yield ('db',
+                                             self.clark.check_existence_many,
+                                             digests.values(), collection_name)
+                else:
+                    digests = None
+            if already_existed:
+                logger.warning("    Duplicated file detected.")
+                METRICS.count('dwarf_files_total', outcome='duplicate')
+                return failure
+
+        # Receive the file in the warehouse dock. It is hashed on the way in so
+        # the file is read only once.
+        with METRICS.time('checksum'):
+            succeed, digests, docked_file = yield ('io', self.stocker.receive,
+                                                   src_file, digests)
+        if not succeed:
+            logger.warning("    Failed to receive the file.")
+            METRICS.count('dwarf_files_total', outcome='io_failure')
+            return failure
+        hash_value = digests[self.stocker.algo]
+        yield 'io', functools.partial(self.journal.write, src_file, HASHED,
+                                      docked=docked_file, hash=hash_value,
+                                      collection=collection_name)
+
+        # Make sure this file was not processed before. The records may be
+        # hashed by different algorithms, try all of them. Those recorded
+        # without a fingerprint are only found here.
+        with METRICS.time('existence'):
+            already_existed = yield ('db', self.clark.check_existence_many,
+                                     digests.values(), collection_name)
         if already_existed:
             logger.warning("    Duplicated file detected.")
+            METRICS.count('dwarf_files_total', outcome='duplicate')
+            yield 'io', self.stocker.destry, docked_file
+            yield 'io', self.journal.write, src_file, CLEANED
             return failure
 
-        # Get the tags of the file.
-        succeed, raw_tags = self.get_raw_tags(src_file,
-                                              parse_func,
-                                              CFG['monitor']['max_num_try'],
-                                              CFG['monitor']['timeout'])
+        # Get the tags of the file. Try the cache first.
+        with METRICS.time('probe'):
+            raw_tags = yield 'io', self.tag_cache.get, hash_value
+            succeed = raw_tags is not None
+            if not succeed:
+                succeed, raw_tags = yield ('probe', self.get_raw_tags,
+                                           src_file, parse_func)
+                if succeed:
+                    yield 'io', self.tag_cache.put, hash_value, raw_tags
         if not succeed:
             logger.warning("    Failed to get file format tags.")
-            return failure
+            METRICS.count('dwarf_files_total', outcome='probe_failure')
+            yield 'io', self.stocker.destry, docked_file
+            yield 'io', self.journal.write, src_file, CLEANED
+            return False, None, True
 
         # Stock the file in the warehouse if any tag got.
-        succeed, dst_file = self.stocker.stock(src_file)
+        with METRICS.time('stock'):
+            succeed, dst_file = yield ('io', self.stocker.stock, docked_file,
+                                       hash_value)
         if not succeed:
             logger.warning("    Failed to move the file.")
+            METRICS.count('dwarf_files_total', outcome='io_failure')
+            yield 'io', self.stocker.destry, docked_file
+            yield 'io', self.journal.write, src_file, CLEANED
             return failure
+        yield 'io', functools.partial(self.journal.write, src_file, STOCKED,
+                                      dst=dst_file, hash=hash_value,
+                                      collection=collection_name)
 
         # Try to get the manual tags and authors. This is mandatory.
-        succeed, manual_tags, authors = self.get_manual_tags(src_file)
+        with METRICS.time('manual_tags'):
+            succeed, manual_tags, authors = yield ('io', self.get_manual_tags,
+                                                   src_file)
         if not succeed:
             logger.warning("    Failed to get manual tags and authors.")
+            METRICS.count('dwarf_files_total', outcome='no_tags')
+            yield 'io', self.stocker.destry, dst_file
+            yield 'io', self.journal.write, src_file, CLEANED
             return failure
 
         # Create a database record and save it.
         record = {"base_name": os.path.basename(src_file),
                   "path": dst_file,
                   "hash": hash_value,
-                  "file_size": os.stat(dst_file).st_size,
+                  "algo": self.stocker.algo,
+                  "file_size": file_size,
+                  "fingerprint": fingerprint,
                   "index_time": datetime.datetime.utcnow(),
                   "raw_tag": raw_tags,
                   "manual_tags": manual_tags,
                   "authors": authors}
+        record.update(get_flat_tags(raw_tags))
+
+        filed_at = time.perf_counter()
+        succeed, record_id, duplicated = yield ('file', self.clark.file_a_record,
+                                                record, collection_name)
+        succeed, record_id = yield ('io', self.settle, src_file, dst_file,
+                                    file_size, filed_at, succeed, record_id,
+                                    duplicated)
+
+        # Have the file painted once it is recorded.
+        if succeed and self.painter is not None:
+            yield 'io', self.paint, record, collection_name, record_id
+
+        return succeed, record_id, False
+
+    def process(self, src_file, on_done):
+        """Process the sample file.
+
+        Args:
+            src_file: the file to be processed.
+            on_done: called with (succeed, record_id, retry) once the file is
+                settled. The records are written in bulk, so this may happen
+                later and on another thread. `retry` is True if the file is
+                not ready yet and should be tried again later.
+        """
+        self._advance(self.stages(src_file), None, on_done)
 
-        self.clark.set_collection(collection_name)
+    def _advance(self, stages, result, on_done):
+        """Run the stages of the file on this thread until it is filed, and
+        go on from the callback once the record is written.
+
+        The callback runs on the clerk's thread, which only logs the errors.
+        Whatever goes wrong, the file is reported, so that its message is
+        always acknowledged.
+        """
         try:
-            record_id = self.clark.keep_a_record(record)
-        except:
-            logger.warning("    Failed to save in database.")
+            while True:
+                stage, func, *args = stages.send(result)
+                if stage == 'file':
+                    func(*args, lambda *filed: self._advance(stages, filed,
+                                                             on_done))
+                    return
+                result = func(*args)
+        except StopIteration as e:
+            on_done(*e.value)
+        except Exception:
+            logger.exception("Failed to process the file.")
+            on_done(False, None, False)
+
+    def settle(self, src_file, dst_file, file_size, filed_at, succeed,
+               record_id, duplicated):
+        """Clean up after the record of the file is written or rejected.
+
+        Returns:
+            (succeed, record_id) of the file.
+        """
+        METRICS.observe('dwarf_stage_seconds', time.perf_counter() - filed_at,
+                        stage='insert')
+
+        if duplicated:
+            # Another worker recorded the same file first. The warehouse copy
+            # belongs to that record now, leave it alone.
+            logger.warning("    {}: Duplicated file detected.".format(src_file))
+            METRICS.count('dwarf_files_total', outcome='duplicate')
+            self.journal.write(src_file, CLEANED)
+            return False, None
+
+        if not succeed:
+            logger.warning("    {}: Failed to save in database.".format(src_file))
+            METRICS.count('dwarf_files_total', outcome='db_failure')
             self.stocker.destry(dst_file)
-            return failure
+            self.journal.write(src_file, CLEANED)
+            return False, None
+        self.journal.write(src_file, RECORDED, record_id=str(record_id))
 
         # Finally, clean the original file.
-        if not self.stocker.destry(src_file):
+        with METRICS.time('cleanup'):
+            removed = self.stocker.destry(src_file)
+        self.journal.write(src_file, CLEANED)
+        if not removed:
             logger.warning(
                 "    Failed to remove the source file. You can remove it manually.")
 
+        METRICS.count('dwarf_files_total', outcome='logged')
+        METRICS.count('dwarf_bytes_total', file_size)
         return True, record_id
 
+    def paint(self, record, collection_name, record_id):
+        """Draw the thumbnails and hash the looks of the stocked file.
+
+        The record is updated once the painting is done. The file is recorded
+        already, so a failure here is only logged.
+        """
+        is_video = collection_name == CFG["mongodb"]["collections"]["videos"]
+        try:
+            duration = float(record['raw_tag']['format']['duration'])
+        except (KeyError, TypeError, ValueError):
+            duration = 0
+
+        try:
+            album = self.stocker.get_shelf(record['hash'], GALLERY)
+            future = self.painter.paint(record['path'], album, record['hash'],
+                                        is_video, duration)
+        except Exception:
+            logger.exception("{}: Failed to paint the file.".format(
+                record['path']))
+            METRICS.count('dwarf_paintings_total', outcome='failure')
+            return
+        future.add_done_callback(lambda future: self._pool.submit(
+            self.frame, record['path'], record_id, collection_name, future))
+
+    def frame(self, dst_file, record_id, collection_name, future):
+        """Save the thumbnails and perceptual hashes in the record."""
+        try:
+            fields = future.result()
+        except:
+            logger.warning("{}: Failed to paint the file.".format(dst_file))
+            METRICS.count('dwarf_paintings_total', outcome='failure')
+            return
+
+        # Flag the file if it looks like any recorded one. It may be resized
+        # or encoded again, so the content hash could not tell.
+        max_distance = CFG['painter']['max_distance']
+        if max_distance:
+            lookalikes = [lookalike for lookalike, _ in self.clark.find_similar(
+                fields['phash'], max_distance, collection_name)
+                if lookalike != record_id]
+            if lookalikes:
+                logger.warning("    {}: Lookalike file detected.".format(dst_file))
+                METRICS.count('dwarf_paintings_total', outcome='lookalike')
+                fields['lookalikes'] = lookalikes
+
+        try:
+            self.clark.update_record(record_id, collection_name, fields,
+                                     stamp='paint_time')
+        except:
+            logger.warning("{}: Failed to save the thumbnails.".format(dst_file))
+            METRICS.count('dwarf_paintings_total', outcome='db_failure')
+            return
+        self.clark.remember_lookalike(record_id, collection_name, fields['phash'])
+
+        METRICS.count('dwarf_paintings_total', outcome='painted')
+
+    def recover(self):
+        """Settle the files left unfinished by the last run.
+
+        The steps already done are not done again. A file stocked but not
+        recorded is removed from the warehouse, and its message, never
+        acknowledged, will bring it back to be processed again.
+        """
+        for entry in self.journal.unfinished():
+            src_file, state = entry['path'], entry['state']
+            logger.info("    Recovering {} file: {}".format(state, src_file))
+
+            if state == HASHED:
+                self.stocker.destry(entry['docked'])
+            elif state == STOCKED:
+                if self.clark.check_existence_many([entry['hash']],
+                                                   entry['collection']):
+                    self.stocker.destry(src_file)
+                else:
+                    self.stocker.destry(entry['dst'])
+            elif state == RECORDED:
+                self.stocker.destry(src_file)
+
+            self.journal.write(src_file, CLEANED)
+
+        self.journal.commit()
+
+    def lease(self, src_file):
+        """Take the file for this node. Return False if another node has
+        taken it."""
+        if not self.lease_ttl:
+            return True
+
+        # The unique hash index still keeps the records right without the
+        # lease, so go on if the lease could not be checked.
+        try:
+            leased = self.clark.acquire_lease(
+                src_file, self.node, self.lease_ttl)
+        except:
+            logger.warning("{}: Failed to take the lease.".format(src_file))
+            leased = True
+
+        if leased:
+            with self._leases_lock:
+                self._leases.add(src_file)
+        return leased
+
+    def release(self, src_file):
+        """Let other nodes take the file."""
+        if not self.lease_ttl:
+            return
+        with self._leases_lock:
+            self._leases.discard(src_file)
+        try:
+            self.clark.release_lease(src_file, self.node)
+        except:
+            logger.warning("{}: Failed to release the lease.".format(src_file))
+
+    def _renew_leases(self):
+        """Extend the leases of the files in process, a few times within
+        every lease term."""
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            with self._leases_lock:
+                keys = list(self._leases)
+            if not keys:
+                continue
+            try:
+                self.clark.renew_leases(keys, self.node, self.lease_ttl)
+            except:
+                logger.warning("Failed to renew the leases.")
+
     def callback(self, ch, method, properties, body):
-        """This is the function that was called when a message is received."""
+        """This is the function that was called when a message is received.
+
+        The message is handed over to the worker pool so that the connection
+        thread is free to receive the next one.
+        """
+        attempts = (properties.headers or {}).get('x-attempts', 0)
+        self._pool.submit(self.work, ch, method.delivery_tag, body, attempts)
+
+    def work(self, ch, delivery_tag, body, attempts):
+        """Process the file in the message on a worker thread."""
         # Get the full file path.
         src_file = body.decode()
         logger.info(" *  File created: {}".format(src_file))
 
-        # Try to process the source file.
-        succeed, record_id = self.process(src_file)
+        # Another node is working on the same file. Leave it alone.
+        if not self.lease(src_file):
+            logger.info("    File taken by another node.")
+            METRICS.count('dwarf_files_total', outcome='leased')
+            return self.report(ch, delivery_tag, body, attempts, False, None)
+
+        # Try to process the source file. The result is reported after the
+        # record is written.
+        def on_done(succeed, record_id, retry=False):
+            self.release(src_file)
+            self.report(ch, delivery_tag, body, attempts, succeed, record_id,
+                        retry)
+
+        try:
+            self.process(src_file, on_done)
+        except:
+            logger.exception("{}: Unexpected error.".format(src_file))
+            on_done(False, None)
+
+    def report(self, ch, delivery_tag, body, attempts, succeed, record_id,
+               retry=False):
+        """Log the result of the file and acknowledge the message.
+
+        A file not ready yet is sent to the retry queue, and will come back
+        after a delay.
+        """
+        src_file = body.decode()
+        attempts += 1
+        retry = retry and attempts < CFG['monitor']['max_num_try']
 
         if succeed:
             logger.info(" ✓  File logged with ID: {}".format(record_id))
+        elif retry:
+            logger.info(" …  File will be tried again later: {}".format(src_file))
         else:
             logger.warning(
-                " ✕  File not processed.")
+                " ✕  File not processed: {}".format(src_file))
+
+        if not retry:
+            self.stocker.check_out(src_file)
+
+        # Tell the rabbit the result. The channel belongs to the connection
+        # thread, so the ack has to be sent from there.
+        def acknowledge():
+            if retry:
+                self._rabbit.postpone(body, attempts)
+            ch.basic_ack(delivery_tag=delivery_tag)
 
-        # Tell the rabbit the result.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        # If the connection is lost, the message will be delivered again.
+        try:
+            ch.connection.add_callback_threadsafe(acknowledge)
+        except pika.exceptions.AMQPError:
+            logger.warning("    Failed to acknowledge: {}".format(src_file))
 
     def start_processing(self):
         """Start to process new files in the barn"""
+        # Finish what was left by the last run first.
+        self.recover()
+
         # Summon a rabbit to deliver the mesages.
         self._rabbit = Rabbit(address=CFG['rabbitmq']['host'],
                               port=CFG['rabbitmq']['port'],
                               queue=CFG['rabbitmq']['queue'],
                               talking=False,
-                              callback=self.callback)
+                              callback=self.callback,
+                              retry_delay=CFG['monitor']['retry_delay'],
+                              num_shards=CFG['rabbitmq']['shards'],
+                              shards=self.shards,
+                              heartbeat=CFG['rabbitmq']['heartbeat'])
+
+        # Keep an eye on the queue.
+        self._rabbit.every(CFG['metrics']['queue_interval'],
+                           lambda: METRICS.set('dwarf_queue_depth',
+                                               self._rabbit.queue_depth()))
 
         # Start listening..
         logger.info('[*] Waiting for messages...')
-        self._rabbit.start_listening()
+        # Keep enough messages in hand for the workers and a full bulk write,
+        # as none of them is acknowledged before its record is written.
+        prefetch_count = self.num_workers + CFG['mongodb']['bulk']['size']
+        self._rabbit.start_listening(prefetch_count=prefetch_count)
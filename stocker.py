@@ -1,17 +1,43 @@
 """A stocker moves the data from the barn to the warehouse."""
 
+import fcntl
+import hashlib
 import logging
 import logging.config
 import os
 import shutil
+import socket
 import sys
-from hashlib import md5 as hash_func
+import threading
+import uuid
+from collections import Counter
 
 import yaml
 
-from rabbit import Rabbit
+from metrics import METRICS
+from rabbit import speaker
+from scout import Logbook, Scout
+
+# Faster hash algorithms are provided by optional packages.
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 RACK = "originals"
+DOCK = "incoming"
+GALLERY = "thumbnails"
+INVENTORY = "inventory.{}.db"
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 1000
+FINGERPRINT_BLOCK = 64 * 1024
+
+# The ioctl request to clone a file on filesystems like Btrfs and XFS.
+FICLONE = 0x40049409
 
 # Setup the logger.
 logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
@@ -23,47 +49,212 @@ with open(CFG_FILE, 'r') as f:
     CFG = yaml.load(f, Loader=yaml.FullLoader)
 
 
+def new_hasher(algo):
+    """Return a new hash object of the algorithm.
+
+    Besides those in hashlib, `blake3` and `xxh3_128` are supported if the
+    optional packages are installed.
+    """
+    if algo == 'blake3':
+        if blake3 is None:
+            raise ValueError("Package blake3 is required by the blake3 hash.")
+        return blake3.blake3()
+    if algo == 'xxh3_128':
+        if xxhash is None:
+            raise ValueError("Package xxhash is required by the xxh3_128 hash.")
+        return xxhash.xxh3_128()
+
+    return hashlib.new(algo)
+
+
+def pump(src, dst=None, buffer=None, algos=("md5",)):
+    """Read the source stream chunk by chunk, hash it and optionally copy it.
+
+    One buffer is reused for the whole stream, so the memory footprint stays
+    the same no matter how large the file is.
+
+    Args:
+        src: a binary file object to read from.
+        dst: a binary file object to write to, or None to hash only.
+        buffer: a bytearray to read into. A new one is made if not provided.
+        algos: the hash algorithms, all fed in the same pass.
+
+    Returns:
+        a dict of the hex digests of the stream, keyed by the algorithm.
+    """
+    hashers = {algo: new_hasher(algo) for algo in algos}
+    buffer = buffer if buffer is not None else bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    while True:
+        num_bytes = src.readinto(buffer)
+        if not num_bytes:
+            break
+        chunk = view[:num_bytes]
+        for hasher in hashers.values():
+            hasher.update(chunk)
+        if dst is not None:
+            dst.write(chunk)
+
+    return {algo: hasher.hexdigest() for algo, hasher in hashers.items()}
+
+
+def place_by_link(src_file, dst_file):
+    """Hard link the file. No data is copied at all."""
+    os.link(src_file, dst_file)
+
+
+def place_by_reflink(src_file, dst_file):
+    """Clone the file. The data blocks are shared until either one changes."""
+    with open(src_file, 'rb') as src, open(dst_file, 'xb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def place_by_copy_file_range(src_file, dst_file):
+    """Copy the file inside the kernel."""
+    with open(src_file, 'rb') as src, open(dst_file, 'xb') as dst:
+        while os.copy_file_range(src.fileno(), dst.fileno(), CHUNK_SIZE * 64):
+            pass
+
+
+def place_by_sendfile(src_file, dst_file):
+    """Copy the file inside the kernel, for the kernels without copy_file_range."""
+    with open(src_file, 'rb') as src, open(dst_file, 'xb') as dst:
+        offset = 0
+        while True:
+            num_bytes = os.sendfile(dst.fileno(), src.fileno(), offset,
+                                    CHUNK_SIZE * 64)
+            if not num_bytes:
+                break
+            offset += num_bytes
+
+
+PLACEMENTS = {"link": place_by_link,
+              "reflink": place_by_reflink,
+              "copy_file_range": place_by_copy_file_range,
+              "sendfile": place_by_sendfile}
+
+
 class Stocker:
 
-    def __init__(self, barn, warehouse):
+    def __init__(self, barn, warehouse, node=None):
         """A stocker moves the data from the barn to the warehouse.
 
         Args:
             barn: the direcotry where the raw data is stored.
             warehouse: the directory where the indexed data is stored.
+            node: the name of this node among those sharing the warehouse,
+                the host name by default.
         """
         self.barn = barn
         self.warehouse = warehouse
-        self._rabbit = Rabbit(address=CFG['rabbitmq']['host'],
-                              port=CFG['rabbitmq']['port'],
-                              queue=CFG['rabbitmq']['queue'],
-                              talking=True)
+        self._local = threading.local()
+
+        # Files are named by the hash of the current algorithm. The legacy
+        # ones are computed in the same pass, so the files recorded before a
+        # switch of algorithm are still found.
+        self.algo = CFG['stocker']['hash']['algo']
+        self.algos = [self.algo] + [algo for algo in CFG['stocker']['hash']['legacy']
+                                    if algo != self.algo]
+
+        # Tell a wrong algorithm before any file is taken in.
+        for algo in self.algos:
+            try:
+                new_hasher(algo)
+            except ValueError as e:
+                raise ValueError("Invalid hash algorithm `{}` in the config "
+                                 "file: {}".format(algo, e)) from None
 
-    def list_files(self, dir):
-        """List all the files in the dir."""
-        all_files = []
-        for dirpath, _, files in os.walk(dir):
-            all_files.extend([os.path.join(dirpath, f) for f in files])
+        # How many files were placed by each strategy.
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
 
-        return all_files
+        # The scout walks the barn, and the logbook remembers the files that
+        # are already in the queue. SQLite could not be shared by the nodes
+        # over a network file system, so every node keeps a logbook of its own.
+        self.scout = Scout(CFG['stocker']['walkers'])
+        os.makedirs(self.warehouse, exist_ok=True)
+        self.logbook = Logbook(os.path.join(
+            self.warehouse, INVENTORY.format(node or socket.gethostname())))
+
+        # The warehouse is sharded by the leading characters of the hash.
+        self.shard_depth = CFG['stocker']['shard']['depth']
+        self.shard_width = CFG['stocker']['shard']['width']
+        self._shelves = set()
+
+    def messenger(self):
+        """Return the rabbit to report the files. It is shared with the porter
+        of the same process."""
+        return speaker()
+
+    def _buffer(self):
+        """Return the read buffer of the current thread.
+
+        Every worker thread keeps its own buffer so that it could be reused
+        for all the files this worker handles.
+        """
+        if not hasattr(self._local, 'buffer'):
+            self._local.buffer = bytearray(CHUNK_SIZE)
+        return self._local.buffer
 
     def check_inventory(self):
-        """List all the files in the barn."""
-        files = self.list_files(self.barn)
+        """Report the new files in the barn.
+
+        The files are reported while the barn is still being walked. Those
+        already in the queue and not changed since then are skipped.
+        """
+        num_files = 0
+        batch = []
+        for path, size, mtime in self.scout.explore(self.barn):
+            if not self.logbook.is_new(path, size, mtime):
+                continue
+            batch.append((path, size, mtime))
+            if len(batch) >= BATCH_SIZE:
+                num_files += self._report(batch)
+                batch = []
+        num_files += self._report(batch)
+        self.logbook.close()
 
         # If any job left, tell people.
-        if files:
-            logger.debug("New files discovered: {}".format(len(files)))
-            for new_file in files:
-                self._rabbit.speak(new_file)
+        if num_files:
+            logger.debug("New files discovered: {}".format(num_files))
+
+    def _report(self, batch):
+        """Send a batch of (path, size, mtime) to the queue and log them."""
+        if not batch:
+            return 0
+
+        if not self.messenger().speak_many([path for path, _, _ in batch]):
+            logger.error("Failed to report {} files.".format(len(batch)))
+            return 0
+
+        for path, size, mtime in batch:
+            self.logbook.write_down(path, size, mtime)
+        self.logbook.commit()
+
+        return len(batch)
+
+    def check_out(self, file_path):
+        """The file left the queue. Report it again if it is still there."""
+        self.logbook.strike_out(file_path)
+
+    def get_checksum(self, file_path, algos=None):
+        """Get the hash values of the input file.
 
-    def get_checksum(self, file_path):
-        """Get the hash value of the input file."""
+        Args:
+            file_path: the file to be hashed.
+            algos: the hash algorithms, all of `self.algos` if not provided.
+
+        Returns:
+            succeed: a flag indicating the process succeeds.
+            digests: a dict of the hash values keyed by the algorithm.
+        """
         failure = False, None
 
         try:
             with open(file_path, 'rb') as f:
-                return True, hash_func(f.read()).hexdigest()
+                return True, pump(f, buffer=self._buffer(),
+                                  algos=algos or self.algos)
         except PermissionError:
             logger.debug(
                 "{}: Failed to open file, permission denied".format(file_path))
@@ -72,46 +263,192 @@ class Stocker:
             logger.debug("{}: Failed to hash file.".format(file_path))
             return failure
 
-    def stock(self, src_file):
-        """Stock the warehouse with the target file.
+    def get_fingerprint(self, file_path):
+        """Get a cheap fingerprint of the file from a few blocks of it.
+
+        Only the head, the middle and the tail blocks are read. Files of
+        different fingerprints are surely different, while those of the same
+        fingerprint should be told apart by the full hash.
+
+        Returns:
+            succeed: a flag indicating the process succeeds.
+            file_size: the size of the file in bytes.
+            fingerprint: the fingerprint of the file.
+        """
+        failure = False, None, None
+
+        try:
+            with open(file_path, 'rb') as f:
+                file_size = os.fstat(f.fileno()).st_size
+                hasher = hashlib.blake2b(digest_size=16)
+                if file_size <= FINGERPRINT_BLOCK * 3:
+                    hasher.update(f.read())
+                else:
+                    for offset in (0,
+                                   (file_size - FINGERPRINT_BLOCK) // 2,
+                                   file_size - FINGERPRINT_BLOCK):
+                        f.seek(offset)
+                        hasher.update(f.read(FINGERPRINT_BLOCK))
+        except PermissionError:
+            logger.debug(
+                "{}: Failed to open file, permission denied".format(file_path))
+            return failure
+        except:
+            logger.debug("{}: Failed to fingerprint file.".format(file_path))
+            return failure
+
+        return True, file_size, hasher.hexdigest()
+
+    def receive(self, src_file, digests=None):
+        """Receive the file into the dock of the warehouse.
+
+        If the barn and the warehouse are on the same device, the file is
+        hashed and then placed in the dock by the cheapest strategy that works,
+        in the order of `stocker.placement`. Otherwise it is hashed on the way
+        in: every byte is read from the barn only once, and the same buffer is
+        fed to the hash function and written to the dock.
 
         Args:
-            src_file: the source file to be stocked.
+            src_file: the source file to be received.
+            digests: the hash values of the file if already computed, so that
+                it is not hashed again.
 
         Returns:
             succeed: a flag indicating the process succeeds.
-            target: the full path of the target file saved.
+            digests: a dict of the hash values keyed by the algorithm.
+            docked_file: the full path of the copy in the dock.
         """
-        failure = False, None
+        failure = False, None, None
 
-        # Get the new path of the file.
-        hash_got, hash_value = self.get_checksum(src_file)
-        if not hash_got:
-            logger.debug("Failed to get the hash value.")
+        dock = os.path.join(self.warehouse, DOCK)
+        os.makedirs(dock, exist_ok=True)
+        docked_file = os.path.join(
+            dock, uuid.uuid4().hex + os.path.splitext(src_file)[-1])
+
+        try:
+            strategy = None
+            if os.stat(src_file).st_dev == os.stat(dock).st_dev:
+                if digests is None:
+                    succeed, digests = self.get_checksum(src_file)
+                    if not succeed:
+                        return failure
+                strategy = self.place(src_file, docked_file)
+
+            # The last resort is a full copy in the user space, hashed on the
+            # way unless that is done already.
+            if strategy is None:
+                with open(src_file, 'rb') as src, open(docked_file, 'xb') as dst:
+                    copied = pump(src, dst, self._buffer(),
+                                  () if digests else self.algos)
+                digests = digests or copied
+                strategy = "copy"
+
+            if strategy != "link":
+                shutil.copystat(src_file, docked_file)
+        except PermissionError:
+            logger.debug(
+                "{}: Failed to receive file, permission denied".format(src_file))
+            self.destry(docked_file)
             return failure
+        except:
+            logger.debug("{}: Failed to receive file.".format(src_file))
+            self.destry(docked_file)
+            return failure
+
+        logger.debug("{}: File received by {}.".format(src_file, strategy))
+        with self._stats_lock:
+            self.stats[strategy] += 1
+        METRICS.count('dwarf_placements_total', strategy=strategy)
 
-        new_name = hash_value + os.path.splitext(src_file)[-1]
-        dst_dir = os.path.join(CFG["dirs"]["warehouse"], RACK, hash_value[0])
+        return True, digests, docked_file
 
-        # If the directories do not exist, make them.
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
+    def place(self, src_file, dst_file):
+        """Place the file without copying it in the user space.
+
+        Note a hard linked file shares the same data with the source file. The
+        link is kept only after the source is removed, so any change made to
+        the source before that shows up in the warehouse as well.
+
+        Returns:
+            the strategy used, or None if none of them worked.
+        """
+        for strategy in CFG['stocker']['placement']:
+            try:
+                PLACEMENTS[strategy](src_file, dst_file)
+                return strategy
+            except (OSError, AttributeError):
+                logger.debug("{}: Failed to place file by {}.".format(
+                    src_file, strategy))
+                if os.path.lexists(dst_file):
+                    os.remove(dst_file)
+
+        return None
+
+    def stock(self, docked_file, hash_value):
+        """Stock the warehouse with the docked file.
+
+        Args:
+            docked_file: the file received in the dock.
+            hash_value: the hash checksum of the file.
+
+        Returns:
+            succeed: a flag indicating the process succeeds.
+            target: the full path of the target file saved.
+        """
+        failure = False, None
+
+        # Get the new path of the file.
+        new_name = hash_value + os.path.splitext(docked_file)[-1]
+        dst_dir = self.get_shelf(hash_value)
         dst_file = os.path.join(dst_dir, new_name)
 
-        # Move the file to the warehouse.
+        # Move the file from the dock to the rack. Both of them are in the
+        # warehouse so this is a cheap rename.
         try:
-            new_path = shutil.copy2(src_file, dst_file)
-            succeed = True
-            logger.debug("{}: File saved.".format(new_path))
+            os.replace(docked_file, dst_file)
+            logger.debug("{}: File saved.".format(dst_file))
         except PermissionError:
             logger.debug(
-                "{}: Failed to copy file, permission denied".format(src_file))
+                "{}: Failed to move file, permission denied".format(docked_file))
             return failure
         except:
-            logger.debug("{}: Failed to copy file.".format(src_file))
+            logger.debug("{}: Failed to move file.".format(docked_file))
             return failure
 
-        return succeed, new_path
+        return True, dst_file
+
+    def get_shelf(self, hash_value, rack=RACK):
+        """Return the directory for the hash value, and make sure it exists.
+
+        With depth 2 and width 2, the file `abcdef...` goes to `ab/cd/`.
+        """
+        parts = [hash_value[i * self.shard_width:(i + 1) * self.shard_width]
+                 for i in range(self.shard_depth)]
+        shelf = os.path.join(self.warehouse, rack, *parts)
+
+        # Only ask the file system once for every directory.
+        if shelf not in self._shelves:
+            os.makedirs(shelf, exist_ok=True)
+            self._shelves.add(shelf)
+
+        return shelf
+
+    def restock(self, file_path):
+        """Move a stocked file to its shelf in the current layout.
+
+        The file is linked to the new path first, so it is always available
+        in at least one of them.
+
+        Returns:
+            the new path of the file, the same as before if not moved.
+        """
+        name = os.path.basename(file_path)
+        new_path = os.path.join(
+            self.get_shelf(os.path.splitext(name)[0]), name)
+        if new_path != file_path and not os.path.exists(new_path):
+            os.link(file_path, new_path)
+
+        return new_path
 
     def destry(self, file_path):
         """Destry a file."""
@@ -0,0 +1,128 @@
+"""Local caches of the file tags."""
+
+import json
+import logging
+import logging.config
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import yaml
+
+# Setup the logger.
+logging.config.dictConfig(yaml.load(open("logging.yml", 'r'), yaml.FullLoader))
+logger = logging.getLogger('steward')
+
+
+class TagCache:
+
+    def __init__(self, db_file, capacity):
+        """The tags are kept in a SQLite file and evicted in LRU order.
+
+        Args:
+            db_file: the SQLite file to keep the tags.
+            capacity: how many bytes of tags could be kept.
+        """
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+
+        # Losing the latest entries in a crash costs nothing but a probe.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                         "hash TEXT PRIMARY KEY, raw_tag TEXT, "
+                         "size INTEGER, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tags_last_used "
+                         "ON tags (last_used)")
+        self._size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tags").fetchone()[0]
+
+    def get(self, hash_value):
+        """Return the cached tags of the hash value, or None if not found."""
+        with self._lock:
+            row = self._db.execute("SELECT raw_tag FROM tags WHERE hash=?",
+                                   (hash_value,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE tags SET last_used=? WHERE hash=?",
+                             (time.time(), hash_value))
+            self._db.commit()
+
+        return json.loads(row[0])
+
+    def put(self, hash_value, raw_tags):
+        """Cache the tags of the hash value."""
+        try:
+            raw_tag = json.dumps(raw_tags)
+        except (TypeError, ValueError):
+            logger.debug("{}: Tags could not be cached.".format(hash_value))
+            return
+
+        with self._lock:
+            row = self._db.execute("SELECT size FROM tags WHERE hash=?",
+                                   (hash_value,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)",
+                             (hash_value, raw_tag, len(raw_tag), time.time()))
+            self._size += len(raw_tag) - (row[0] if row else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Remove the least recently used tags until the cache fits."""
+        while self._size > self.capacity:
+            rows = self._db.execute("SELECT hash, size FROM tags "
+                                    "ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                break
+            for hash_value, size in rows:
+                if self._size <= self.capacity:
+                    break
+                self._db.execute("DELETE FROM tags WHERE hash=?", (hash_value,))
+                self._size -= size
+
+
+class ManualTagCache:
+
+    def __init__(self, capacity=4096, ttl=60):
+        """Remember the manual tags and authors of every directory.
+
+        The entries of a directory should be forgotten once its tag files
+        change. Those missed, like the changes made while nobody watches,
+        are read again once the entries expire.
+
+        Args:
+            capacity: how many directories to remember.
+            ttl: how many seconds an entry is kept.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, directory):
+        """Return the cached value of the directory, or None if not found."""
+        with self._lock:
+            entry = self._entries.get(directory)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self._entries.move_to_end(directory)
+            return entry[1]
+
+    def put(self, directory, value):
+        """Remember the value of the directory."""
+        with self._lock:
+            self._entries[directory] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(directory)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def forget(self, directory):
+        """Forget the directory and all the directories inside it."""
+        prefix = directory.rstrip(os.path.sep) + os.path.sep
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key == directory or key.startswith(prefix)]:
+                del self._entries[key]
@@ -0,0 +1,40 @@
+"""The journal finds the unfinished files after a crash."""
+
+import json
+
+from journal import CLEANED, HASHED, RECORDED, STOCKED, Journal, replay
+
+
+def test_replay_cut_off(tmp_path):
+    journal_file = tmp_path / 'journal.log'
+    lines = [{'path': 'a', 'state': HASHED, 'docked': 'dock/a'},
+             {'path': 'b', 'state': HASHED, 'docked': 'dock/b'},
+             {'path': 'a', 'state': STOCKED, 'dst': 'rack/a'},
+             {'path': 'b', 'state': CLEANED},
+             {'path': 'c', 'state': RECORDED, 'record_id': '1'}]
+    text = "".join(json.dumps(line) + "\n" for line in lines)
+
+    # The crash cut the last entry short.
+    text += json.dumps({'path': 'c', 'state': CLEANED})[:10]
+    journal_file.write_text(text)
+
+    entries = replay(str(journal_file))
+    assert set(entries) == {'a', 'c'}
+    assert entries['a']['state'] == STOCKED
+    assert entries['a']['dst'] == 'rack/a'
+    assert entries['c']['state'] == RECORDED
+
+
+def test_replay_missing(tmp_path):
+    assert replay(str(tmp_path / 'journal.log')) == {}
+
+
+def test_reopen(tmp_path):
+    journal_file = str(tmp_path / 'journal.log')
+    journal = Journal(journal_file, commit_interval=60)
+    journal.write('a', HASHED, docked='dock/a')
+    journal.write('b', HASHED, docked='dock/b')
+    journal.write('b', CLEANED)
+    journal.commit()
+    assert [entry['path'] for entry in journal.unfinished()] == ['a']
+    assert set(replay(journal_file)) == {'a'}
@@ -0,0 +1,55 @@
+"""The lookalike index finds the same hashes as a brute force search."""
+
+import random
+
+from lookalike import LookalikeIndex
+
+
+def brute_force(hashes, phash, max_distance):
+    value = int(phash, 16)
+    return sorted((key, bin(int(other, 16) ^ value).count('1'))
+                  for key, other in hashes.items()
+                  if bin(int(other, 16) ^ value).count('1') <= max_distance)
+
+
+def flip(value, num_bits, rng):
+    for bit in rng.sample(range(64), num_bits):
+        value ^= 1 << bit
+    return value
+
+
+def test_find_as_brute_force():
+    rng = random.Random(7)
+    bases = [rng.getrandbits(64) for _ in range(50)]
+
+    # Many near ones around a few bases, and some far ones.
+    hashes = {}
+    for key in range(3000):
+        value = flip(rng.choice(bases), rng.randint(0, 12), rng) \
+            if key % 3 else rng.getrandbits(64)
+        hashes[key] = '{:016x}'.format(value)
+
+    index = LookalikeIndex()
+    for key, phash in hashes.items():
+        index.add(key, phash)
+    assert len(index) == len(hashes)
+
+    for _ in range(100):
+        phash = '{:016x}'.format(flip(rng.choice(bases), rng.randint(0, 6), rng))
+        for max_distance in (0, 3, 6, 10):
+            found = index.find(phash, max_distance)
+            assert sorted(found) == brute_force(hashes, phash, max_distance)
+            assert [distance for _, distance in found] == \
+                sorted(distance for _, distance in found)
+
+
+def test_replace_and_remove():
+    index = LookalikeIndex()
+    index.add('a', 'ffffffffffffffff')
+    index.add('a', '0000000000000000')
+    assert index.find('0000000000000001', 1) == [('a', 1)]
+    assert index.find('ffffffffffffffff', 6) == []
+
+    index.remove('a')
+    assert len(index) == 0
+    assert index.find('0000000000000000', 6) == []
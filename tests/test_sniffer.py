@@ -0,0 +1,99 @@
+"""The sniffers read the right tags, and give up on the unusual headers."""
+
+import struct
+
+import pytest
+
+from sniffer import sniff_image, sniff_video
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def png(width, height):
+    return (b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', width, height)
+            + b'\0' * 20)
+
+
+def jpeg(width, height):
+    return (b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', 1002) + b'\0' * 1000
+            + b'\xff\xff\xc0' + struct.pack('>HBHH', 17, 8, height, width)
+            + b'\0' * 20)
+
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload):
+    return box(kind, b'\0\0\0\0' + payload)
+
+
+def track(handler, codec, width=0, height=0):
+    entry = (struct.pack('>I4s', 86, codec) + b'\0' * 6 + b'\0\1' + b'\0' * 16
+             + struct.pack('>HH', width, height) + b'\0' * 50)
+    stsd = full_box(b'stsd', struct.pack('>I', 1) + entry)
+    mdia = box(b'mdia', full_box(b'mdhd', struct.pack('>IIII', 0, 0, 90000, 900000)
+                                 + b'\0' * 4)
+               + full_box(b'hdlr', b'\0' * 4 + handler + b'\0' * 12)
+               + box(b'minf', box(b'stbl', stsd)))
+    return box(b'trak', full_box(b'tkhd', b'\0' * 80) + mdia)
+
+
+def mp4():
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, 12345) + b'\0' * 80)
+    moov = box(b'moov', mvhd + track(b'vide', b'avc1', 1920, 1080)
+               + track(b'soun', b'mp4a'))
+    return box(b'ftyp', b'isom\0\0\0\0') + box(b'mdat', b'x' * 1000) + moov
+
+
+@pytest.mark.parametrize('name, data, expected', [
+    ('a.png', png(300, 200), ('PNG', 300, 200)),
+    ('a.gif', b'GIF89a' + struct.pack('<HH', 30, 20) + b'\0' * 30, ('GIF', 30, 20)),
+    ('a.bmp', b'BM' + b'\0' * 12 + struct.pack('<Iii', 40, 33, -22) + b'\0' * 20,
+     ('BMP', 33, 22)),
+    ('a.jpg', jpeg(640, 480), ('JPEG', 640, 480)),
+])
+def test_sniff_image(tmp_path, name, data, expected):
+    tags = sniff_image(write(tmp_path, name, data))
+    assert (tags['format'], tags['width:'], tags['height']) == expected
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    png(300, 200)[:20],
+    png(300, 200)[:24 - 1],
+    b'GIF89a\x01',
+    b'BM' + b'\0' * 10,
+    b'\xff\xd8',
+    b'\xff\xd8\xff\xda',
+    jpeg(640, 480)[:1010],
+    b'not an image at all',
+])
+def test_sniff_image_odd_headers(tmp_path, data):
+    assert sniff_image(write(tmp_path, 'odd', data)) is None
+
+
+def test_sniff_video_mp4(tmp_path):
+    tags = sniff_video(write(tmp_path, 'a.mp4', mp4()))
+    video, audio = tags['streams']
+    assert (video['codec_name'], video['width'], video['height']) == \
+        ('h264', 1920, 1080)
+    assert audio['codec_name'] == 'aac'
+    assert tags['format']['duration'] == '12.345000'
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    box(b'ftyp', b'isom\0\0\0\0'),
+    mp4()[:-40],
+    box(b'ftyp', b'isom\0\0\0\0') + struct.pack('>I4s', 0xFFFFFFF0, b'moov'),
+    box(b'ftyp', b'isom\0\0\0\0') + struct.pack('>I4s', 3, b'moov'),
+    b'RIFF\0\0\0\0AVI ',
+    b'RIFF\0\0\0\0AVI LIST\xff\xff\xff\x7fhdrl',
+])
+def test_sniff_video_odd_headers(tmp_path, data):
+    assert sniff_video(write(tmp_path, 'odd', data)) is None